@@ -0,0 +1,317 @@
+#! /usr/bin/env python3
+
+"""
+Load generator and latency benchmark for the HTTP server
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'http_server.py')
+MODES = {'threaded': ['-m', 'threaded'],
+         'eventloop': ['-m', 'eventloop'],
+         'prefork': ['-m', 'threaded', '-n', str(os.cpu_count() or 2)]}
+
+
+class SyntheticTree(object):
+    """
+    Temporary resource directory with many small files and a few huge ones
+    """
+    small_extensions = ['html', 'css', 'js', 'txt', 'json', 'png']
+
+    def __init__(self, small_files=1000, small_size=4096, large_files=3,
+                 large_size=16 << 20):
+        self.root = tempfile.mkdtemp(prefix='http_bench_')
+        self.www = os.path.join(self.root, 'www')
+        self.small = []
+        self.large = []
+        os.mkdir(self.www)
+        for i in range(small_files):
+            ext = self.small_extensions[i % len(self.small_extensions)]
+            name = 'd%02d/file%05d.%s' % (i % 32, i, ext)
+            size = random.randint(small_size // 4, small_size)
+            self._write(name, size)
+            self.small.append(name)
+        for i in range(large_files):
+            name = 'large/blob%d.bin' % i
+            self._write(name, large_size)
+            self.large.append(name)
+
+    def _write(self, name, size):
+        path = os.path.join(self.www, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fout:
+            # Text-like content so compressible types stay compressible
+            line = b'benchmark payload line for the http server\n'
+            fout.write((line * (size // len(line) + 1))[:size])
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class ServerProcess(object):
+    """
+    HTTP server running in a subprocess on a free loopback port
+    """
+
+    def __init__(self, root, mode_args, extra_args=None):
+        self.port = self._free_port()
+        args = [sys.executable, SERVER_SCRIPT, '-p', str(self.port)] + \
+            mode_args + (extra_args or [])
+        self.process = subprocess.Popen(args, cwd=root,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        self._wait_ready()
+
+    @staticmethod
+    def _free_port():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def _wait_ready(self, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("Server exited with code %s" %
+                                   self.process.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                # Let prefork workers start listening too
+                time.sleep(0.5)
+                return
+            except socket.error:
+                time.sleep(0.1)
+        raise RuntimeError("Server did not start listening")
+
+    def rss(self):
+        """
+        Resident memory of the server and its worker processes in kB
+        """
+        total = 0
+        for pid in [self.process.pid] + self._children():
+            try:
+                with open('/proc/%d/status' % pid) as fin:
+                    for line in fin:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1])
+            except (IOError, OSError):
+                pass
+        return total
+
+    def _children(self):
+        try:
+            with open('/proc/%d/task/%d/children' %
+                      (self.process.pid, self.process.pid)) as fin:
+                return [int(pid) for pid in fin.read().split()]
+        except (IOError, OSError):
+            return []
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class LoadGenerator(object):
+    """
+    Closed-loop clients issuing GET requests over persistent connections
+    """
+
+    def __init__(self, port, files, large_files, concurrency=16,
+                 duration=10, large_ratio=0.01):
+        self.port = port
+        self.files = files
+        self.large_files = large_files
+        self.concurrency = concurrency
+        self.duration = duration
+        self.large_ratio = large_ratio
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def run(self):
+        """
+        Drive the server with all the clients for the configured duration
+        :return: Elapsed seconds
+        """
+        deadline = time.time() + self.duration
+        clients = [threading.Thread(target=self._client, args=(deadline,))
+                   for _ in range(self.concurrency)]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        return time.perf_counter() - start
+
+    def _client(self, deadline):
+        latencies = []
+        errors = 0
+        received = 0
+        conn = None
+        while time.time() < deadline:
+            if self.large_files and random.random() < self.large_ratio:
+                path = random.choice(self.large_files)
+            else:
+                path = random.choice(self.files)
+            try:
+                if conn is None:
+                    conn = http.client.HTTPConnection('127.0.0.1', self.port,
+                                                      timeout=30)
+                start = time.perf_counter()
+                conn.request('GET', '/' + path)
+                response = conn.getresponse()
+                body = response.read()
+                latencies.append(time.perf_counter() - start)
+                received += len(body)
+                if response.status != 200:
+                    errors += 1
+                if response.will_close:
+                    conn.close()
+                    conn = None
+            except (socket.error, http.client.HTTPException):
+                errors += 1
+                if conn is not None:
+                    conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.errors += errors
+            self.bytes += received
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def run_mode(mode, tree, args):
+    """
+    Benchmark one serving mode
+    :return: Dict of results
+    """
+    server = ServerProcess(tree.root, MODES[mode], args.server_args)
+    try:
+        rss_before = server.rss()
+        load = LoadGenerator(server.port, tree.small, tree.large,
+                             args.concurrency, args.duration,
+                             args.large_ratio)
+        elapsed = load.run()
+        rss_after = server.rss()
+    finally:
+        server.stop()
+    latencies = sorted(load.latencies)
+    requests = len(latencies)
+    return {'requests': requests,
+            'errors': load.errors,
+            'seconds': round(elapsed, 3),
+            'requests_per_sec': round(requests / elapsed, 1),
+            'megabytes_per_sec': round(load.bytes / elapsed / (1 << 20), 2),
+            'latency_ms': {
+                'mean': round(1000 * sum(latencies) / max(requests, 1), 3),
+                'p50': round(1000 * percentile(latencies, 0.5), 3),
+                'p99': round(1000 * percentile(latencies, 0.99), 3),
+                'p999': round(1000 * percentile(latencies, 0.999), 3),
+                'max': round(1000 * (latencies[-1] if latencies else 0), 3)},
+            'rss_kb': {'before': rss_before,
+                       'after': rss_after,
+                       'growth': rss_after - rss_before}}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES.keys()),
+                        default=['threaded', 'eventloop'],
+                        help="Serving modes to benchmark")
+    parser.add_argument('-c', '--concurrency', type=int, default=16,
+                        help="Number of concurrent clients")
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help="Seconds of load per mode")
+    parser.add_argument('--small-files', type=int, default=1000,
+                        help="Number of small files in the synthetic tree")
+    parser.add_argument('--small-size', type=int, default=4096,
+                        help="Maximum size of a small file in bytes")
+    parser.add_argument('--large-files', type=int, default=3,
+                        help="Number of large files in the synthetic tree")
+    parser.add_argument('--large-size', type=int, default=16 << 20,
+                        help="Size of a large file in bytes")
+    parser.add_argument('--large-ratio', type=float, default=0.01,
+                        help="Fraction of requests asking for a large file")
+    parser.add_argument('-o', '--output', default='bench_results.json',
+                        help="JSON file the results are written to")
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help="Extra arguments for the server, after --")
+    args = parser.parse_args()
+    if args.server_args and args.server_args[0] == '--':
+        args.server_args = args.server_args[1:]
+    return args
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logger = logging.getLogger(__name__)
+    tree = SyntheticTree(args.small_files, args.small_size, args.large_files,
+                         args.large_size)
+    results = {'config': {'concurrency': args.concurrency,
+                          'duration': args.duration,
+                          'small_files': args.small_files,
+                          'small_size': args.small_size,
+                          'large_files': args.large_files,
+                          'large_size': args.large_size,
+                          'large_ratio': args.large_ratio,
+                          'server_args': args.server_args},
+               'host': {'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'modes': {}}
+    try:
+        for mode in args.modes:
+            logger.info("Benchmarking %s mode..." % mode)
+            result = run_mode(mode, tree, args)
+            results['modes'][mode] = result
+            logger.info("  %8.1f req/s  p50 %.2f ms  p99 %.2f ms  "
+                        "p99.9 %.2f ms  errors %d  rss +%d kB" %
+                        (result['requests_per_sec'],
+                         result['latency_ms']['p50'],
+                         result['latency_ms']['p99'],
+                         result['latency_ms']['p999'],
+                         result['errors'], result['rss_kb']['growth']))
+    finally:
+        tree.remove()
+    with open(args.output, 'w') as fout:
+        json.dump(results, fout, indent=2, sort_keys=True)
+    logger.info("Results saved to %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,159 +1,3017 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 
 """
 A Multi-threaded HTTP server
 """
 
+import argparse
+import binascii
+import bisect
+import collections
+import errno
+import gzip
+import html
+import http.client
 import logging
+import marshal
+import mmap
+import multiprocessing
+import multiprocessing.connection
 import os
 import re
+import select
+import selectors
+import signal
 import socket
+import ssl
+import struct
 import sys
 import threading
+import time
+import zlib
+from email.utils import parsedate_tz, mktime_tz
+from queue import Queue, Full
+from urllib.parse import quote, unquote
 from time import strftime, gmtime
 
 
+# Exceptions of non-blocking sockets, plain or TLS, that have to wait for
+# the socket to become ready again
+WOULD_BLOCK = (BlockingIOError, InterruptedError, ssl.SSLWantReadError,
+               ssl.SSLWantWriteError)
+
+
+class WorkerPool(object):
+    """
+    Fixed-size pool of worker threads fed from a bounded queue
+    """
+
+    def __init__(self, handler, workers=8, queue_size=32):
+        """
+        :param handler: Callable invoked by a worker for each queued item
+        :param workers: Number of worker threads
+        :param queue_size: Maximum number of items waiting for a worker
+        """
+        self.handler = handler
+        self.size = workers
+        self.queue = Queue(maxsize=queue_size)
+        self.threads = []
+        self.logger = logging.getLogger(__name__)
+        self.stats_lock = threading.Lock()
+        self.busy = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.saturated = 0
+        self.max_queue_depth = 0
+
+    def start(self):
+        """
+        Start all the worker threads
+        """
+        for i in range(self.size):
+            worker = threading.Thread(target=self._work,
+                                      name="worker-%d" % i)
+            worker.daemon = True
+            self.threads.append(worker)
+            worker.start()
+
+    def submit(self, item, timeout=0):
+        """
+        Queue item for the workers.
+        :param item: Tuple of arguments passed to the handler
+        :param timeout: Seconds to wait for a free queue slot, 0 to reject
+                        immediately and None to block until one is free
+        :return: True if the item was queued, False if it was rejected
+        """
+        with self.stats_lock:
+            if self.busy >= self.size:
+                self.saturated += 1
+        try:
+            if timeout == 0:
+                self.queue.put_nowait(item)
+            else:
+                self.queue.put(item, timeout=timeout)
+        except Full:
+            with self.stats_lock:
+                self.rejected += 1
+            return False
+        with self.stats_lock:
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth,
+                                       self.queue.qsize())
+        return True
+
+    def stats(self):
+        """
+        Snapshot of the pool counters
+        """
+        with self.stats_lock:
+            return {'workers': self.size,
+                    'busy': self.busy,
+                    'queue_depth': self.queue.qsize(),
+                    'max_queue_depth': self.max_queue_depth,
+                    'submitted': self.submitted,
+                    'rejected': self.rejected,
+                    'saturated': self.saturated}
+
+    def shutdown(self):
+        """
+        Let the workers drain the queue and wait for them to exit
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for worker in self.threads:
+            worker.join()
+        self.threads = []
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            with self.stats_lock:
+                self.busy += 1
+            try:
+                self.handler(*item)
+            except Exception as e:
+                self.logger.error(e)
+            finally:
+                with self.stats_lock:
+                    self.busy -= 1
+
+
+class StreamedBody(object):
+    """
+    Body part of unknown size produced while the response is sent, from an
+    iterable of bytes. Each piece is framed as a chunk of the chunked
+    transfer coding, unless the header announced the length of the body.
+    """
+
+    def __init__(self, chunks, chunked=True):
+        self.chunks = iter(chunks)
+        self.source = chunks
+        self.chunked = chunked
+        self.done = False
+
+    def next(self):
+        """
+        :return: Next bytes to send, None once the body is complete
+        """
+        if self.done:
+            return None
+        for data in self.chunks:
+            if data:
+                if self.chunked:
+                    return b'%x\r\n' % len(data) + data + b'\r\n'
+                return data
+        self.done = True
+        self.close()
+        return b'0\r\n\r\n' if self.chunked else None
+
+    def close(self):
+        close = getattr(self.source, 'close', None)
+        if close is not None:
+            close()
+
+
+class Response(object):
+    """
+    Reply to a single request: header bytes followed by body parts that are
+    in-memory bytes, byte ranges of an open file or a StreamedBody. File
+    ranges are sent with os.sendfile when possible.
+    """
+    chunk_size = 65536
+
+    def __init__(self, code, header, body=b'', fin=None, offset=0, count=0):
+        self.code = code
+        self.requested_file = None
+        # Generated pages are logged but not counted as file accesses
+        self.counted = True
+        self.request = None
+        self.header = header
+        self.parts = collections.deque()
+        self.fin = fin
+        self.use_sendfile = hasattr(os, 'sendfile')
+        self.buffer = None
+        self.chunk = b''
+        self.size = 0
+        self.send_started = None
+        if fin is None and len(body) < self.chunk_size:
+            # One send for the header and a small body
+            self.add(header + body)
+        else:
+            self.add(header)
+            self.add(body)
+        if fin is not None:
+            self.add_file_range(offset, count)
+
+    def add(self, data):
+        """
+        Append in-memory bytes to the body
+        """
+        if data:
+            self.parts.append(memoryview(data))
+            self.size += len(data)
+
+    def add_file_range(self, offset, count):
+        """
+        Append count bytes of the open file starting at offset to the body
+        """
+        if count > 0:
+            self.parts.append([offset, count])
+            self.size += count
+
+    def add_stream(self, chunks, chunked=True):
+        """
+        Append a body produced while sending, from an iterable of bytes.
+        The header must announce either the chunked transfer coding or,
+        when chunked is False, the length of the body.
+        """
+        self.parts.append(StreamedBody(chunks, chunked))
+
+    def drop_body(self):
+        """
+        Keep only the header, for replies to HEAD requests
+        """
+        self.close()
+        self.parts = collections.deque([memoryview(self.header)])
+        self.size = len(self.header)
+
+    def send(self, sock):
+        """
+        Send as much of the response as the socket accepts. On a non-blocking
+        socket BlockingIOError is raised when the socket buffer is full.
+        :return: True once the whole response is sent
+        """
+        if self.use_sendfile and isinstance(sock, ssl.SSLSocket):
+            # The file has to go through the TLS layer
+            self.use_sendfile = False
+        while self.parts:
+            part = self.parts[0]
+            if isinstance(part, memoryview):
+                sent = sock.send(part)
+                if sent < len(part):
+                    self.parts[0] = part[sent:]
+                    continue
+            elif isinstance(part, StreamedBody):
+                data = part.next()
+                if data:
+                    self.parts.appendleft(memoryview(data))
+                    self.size += len(data)
+                    continue
+            else:
+                if self.use_sendfile:
+                    sent = self._sendfile(sock, part[0], part[1])
+                else:
+                    sent = self._send_chunk(sock, part[0], part[1])
+                if sent == 0:
+                    raise IOError("File truncated while sending")
+                part[0] += sent
+                part[1] -= sent
+                if part[1] > 0:
+                    continue
+            self.parts.popleft()
+        self.close()
+        return True
+
+    def send_blocking(self, sock, timeout):
+        """
+        Send the whole response, waiting up to timeout seconds each time
+        the socket buffer is full
+        """
+        while True:
+            try:
+                return self.send(sock)
+            except WOULD_BLOCK:
+                if not select.select([], [sock], [], timeout)[1]:
+                    raise socket.timeout("Timed out sending response")
+
+    def close(self):
+        for part in self.parts:
+            if isinstance(part, StreamedBody):
+                part.close()
+        if self.fin is not None:
+            self.fin.close()
+            self.fin = None
+
+    def _sendfile(self, sock, offset, count):
+        """
+        Copy the next part of the file straight from the page cache to the
+        socket
+        """
+        try:
+            return os.sendfile(sock.fileno(), self.fin.fileno(), offset, count)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                               errno.EOPNOTSUPP):
+                raise
+        self.use_sendfile = False
+        return self._send_chunk(sock, offset, count)
+
+    def _send_chunk(self, sock, offset, count):
+        """
+        Fallback for sendfile: send the file through a reused buffer
+        """
+        if not self.chunk:
+            if self.buffer is None:
+                self.buffer = bytearray(self.chunk_size)
+            self.fin.seek(offset)
+            read = self.fin.readinto(self.buffer)
+            self.chunk = memoryview(self.buffer)[:min(read, count)]
+            if not self.chunk:
+                return 0
+        sent = sock.send(self.chunk)
+        self.chunk = self.chunk[sent:]
+        return sent
+
+
+class CachedFile(object):
+    """
+    Response fields and body of a file, tagged with the mtime and size they
+    were built from. The header fields describing the file are formatted
+    once, when the entry is built.
+    """
+    fields_template = "Last-Modified: %s\r\nETag: %s\r\nAccept-Ranges: bytes" +\
+                      "\r\nContent-Type: %s\r\n%s%s"
+
+    def __init__(self, path, stat, last_modified, content_type, body,
+                 encoding=None, vary=False, chunked=False):
+        """
+        :param path: File the entry was built from
+        :param stat: os.stat_result of that file
+        :param body: File contents, None if the file is sent with sendfile
+        :param encoding: Content-Encoding of the body, None for identity
+        :param vary: True if other encodings of the file may be served
+        :param chunked: True if the body is encoded while it is sent, with
+                        the chunked transfer coding as its length is unknown
+        """
+        self.path = path
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.length = stat.st_size if body is None else len(body)
+        length_field = "Content-Length: %d\r\n" % self.length
+        if chunked:
+            self.length = None
+            length_field = "Transfer-Encoding: chunked\r\n"
+        self.last_modified = last_modified
+        self.content_type = content_type
+        self.body = body
+        self.encoding = encoding
+        self.etag = '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)
+        self.extra_headers = ""
+        if encoding:
+            self.etag = self.etag[:-1] + '-' + encoding + '"'
+            self.extra_headers = "Content-Encoding: %s\r\n" % encoding
+        if encoding or vary:
+            self.extra_headers += "Vary: Accept-Encoding\r\n"
+        self.header_fields = (self.fields_template % (
+            last_modified, self.etag, content_type, length_field,
+            self.extra_headers)).encode('ascii')
+        self.checked = time.time()
+        # (path, mtime, size) of the file a precompressed sibling stands
+        # for, which invalidates the entry too when it changes
+        self.source = None
+
+    def nbytes(self):
+        return len(self.body) + len(self.path) + len(self.last_modified) + \
+            len(self.content_type) + len(self.etag) + \
+            len(self.extra_headers) + len(self.header_fields)
+
+    def not_modified(self, headers):
+        """
+        Check the conditional request headers against this version of the
+        file. If-None-Match takes precedence over If-Modified-Since.
+        :param headers: Request headers with lower-case names
+        :return: True if the client copy is still valid
+        """
+        if_none_match = headers.get('if-none-match')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return True
+            for etag in if_none_match.split(','):
+                etag = etag.strip()
+                if etag.startswith('W/'):
+                    etag = etag[2:]
+                if etag == self.etag:
+                    return True
+            return False
+        if_modified_since = headers.get('if-modified-since')
+        if if_modified_since is not None:
+            since = parsedate_tz(if_modified_since)
+            if since is not None:
+                try:
+                    return int(self.mtime) <= mktime_tz(since)
+                except (ValueError, OverflowError):
+                    # Invalid date: the header is ignored
+                    pass
+        return False
+
+    def if_range(self, headers):
+        """
+        Check If-Range: a Range header only applies while the validator the
+        client sent still matches this version of the file
+        """
+        if_range = headers.get('if-range')
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            return if_range == self.etag
+        return if_range == self.last_modified
+
+
+class ResponseCache(object):
+    """
+    Least recently used cache of file responses bounded by total body size
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes, check_interval=1):
+        """
+        :param max_bytes: Byte budget for all the cached entries
+        :param max_entry_bytes: Largest entry that is cached
+        :param check_interval: Seconds an entry is trusted before its file
+                               is stat'ed again to detect changes
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.check_interval = check_interval
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Look up an entry, dropping it if the file it was built from has
+        changed
+        :param key: File path, or a (file path, encoding) tuple for encoded
+                    variants of the file
+        :return: CachedFile or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+        now = time.time()
+        if now - entry.checked >= self.check_interval:
+            try:
+                stat = os.stat(entry.path)
+                changed = stat.st_mtime != entry.mtime or \
+                    stat.st_size != entry.size
+                if not changed and entry.source is not None:
+                    stat = os.stat(entry.source[0])
+                    changed = (stat.st_mtime, stat.st_size) != \
+                        entry.source[1:]
+            except OSError:
+                changed = True
+            if changed:
+                with self.lock:
+                    self._remove(key)
+                    self.invalidations += 1
+                    self.misses += 1
+                return None
+            entry.checked = now
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.hits += 1
+        return entry
+
+    def put(self, entry, key=None):
+        """
+        Add an entry, evicting the least recently used ones over the budget
+        :param key: Cache key, the entry's file path by default
+        """
+        nbytes = entry.nbytes()
+        if nbytes > self.max_entry_bytes:
+            return
+        key = key or entry.path
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = entry
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes()
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'bytes': self.size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations}
+
+    def drop_outside(self, root):
+        """
+        Drop the entries of files that are not under a directory, once the
+        resource directory has been switched to another tree
+        """
+        prefix = os.path.join(root, '')
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if not entry.path.startswith(prefix):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.nbytes()
+
+
+class MappedFiles(ResponseCache):
+    """
+    Files too large for the response cache, memory mapped once and shared by
+    all the responses as memoryview slices of the mapping. Entries are
+    dropped when their file changes and the file is mapped again on the next
+    request; responses still sending the old version keep its mapping alive
+    until they release it. Files should be replaced by renaming a new file
+    over them: truncating a mapped file in place faults readers past the
+    new end. The kernel reports such a fault to send() as an error, but a
+    copy in userspace kills the process with SIGBUS, so mappings are only
+    used for bodies sent on their own on plain sockets: never with TLS, and
+    never for files small enough to be sent along with the header.
+    """
+
+    def map(self, fin, path, stat, last_modified, content_type, vary):
+        """
+        Map an open file and register the entry
+        :return: CachedFile whose body is a memoryview of the mapping
+        """
+        body = memoryview(mmap.mmap(fin.fileno(), stat.st_size,
+                                    access=mmap.ACCESS_READ))
+        entry = CachedFile(path, stat, last_modified, content_type, body,
+                           vary=vary)
+        self.put(entry)
+        return entry
+
+
+class DateHeader(object):
+    """
+    Date and Server header fields, formatted at most once per second
+    """
+
+    def __init__(self, server_name, date_format):
+        """
+        :param date_format: strftime format of HTTP dates
+        """
+        self.server_name = server_name
+        self.date_format = date_format
+        self.current = (None, "", b"")
+
+    def value(self):
+        """
+        :return: Current date in the HTTP date format
+        """
+        return self._current()[1]
+
+    def fields(self):
+        """
+        :return: Encoded Date and Server header lines
+        """
+        return self._current()[2]
+
+    def _current(self):
+        second = int(time.time())
+        current = self.current
+        if current[0] != second:
+            date = strftime(self.date_format, gmtime(second))
+            fields = ("Date: %s\r\nServer: %s\r\n" %
+                      (date, self.server_name)).encode('ascii')
+            # Replaced as a whole so readers never see a torn update
+            current = self.current = (second, date, fields)
+        return current
+
+
+IndexedDir = collections.namedtuple('IndexedDir', 'mtime files subdirs')
+# One published generation of the file index: the resolved resource
+# directory, the set of relative file paths and the IndexedDir of each
+# relative directory. Never modified once published.
+IndexSnapshot = collections.namedtuple('IndexSnapshot',
+                                       'generation root files dirs')
+# Fields of os.stat_result used by CachedFile, for generated content
+ContentStat = collections.namedtuple('ContentStat', 'st_mtime st_size')
+
+
+class MimeTable(object):
+    """
+    File extension to mime type table compiled from a mime.types file. The
+    file is parsed on the first lookup, or the table is loaded from a
+    compiled copy on disk that is rebuilt whenever the source file changes.
+    """
+    version = 1
+
+    def __init__(self, path='/etc/mime.types', cache_path=None):
+        """
+        :param cache_path: File the compiled table is kept in, None to parse
+                           the source file in every process
+        """
+        self.path = path
+        self.cache_path = cache_path
+        self.types = None
+        self.compressible = frozenset()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def get(self, ext, default=None):
+        types = self.types
+        if types is None:
+            types = self.load()
+        return types.get(ext, default)
+
+    def load(self):
+        """
+        Compile the table unless it is already loaded
+        :return: Dict of extension to mime type
+        """
+        with self.lock:
+            if self.types is not None:
+                return self.types
+            try:
+                stat = os.stat(self.path)
+                source = (self.version, stat.st_mtime, stat.st_size)
+            except OSError as e:
+                self.logger.warning("No mime types: %s" % e)
+                source = None
+            compiled = self._read_cache(source)
+            if compiled is None:
+                compiled = self._parse() if source else ({}, [])
+                self._write_cache(source, compiled)
+            self.compressible = frozenset(compiled[1])
+            self.types = compiled[0]
+            return self.types
+
+    def _parse(self):
+        types = {}
+        with open(self.path) as fin:
+            for line in fin:
+                if line.startswith('#'):
+                    continue
+                fields = line.split()
+                for ext in fields[1:]:
+                    types[ext] = fields[0]
+        compressible = sorted(set(
+            mime_type for mime_type in types.values()
+            if self.compressible_type(mime_type)))
+        return types, compressible
+
+    def _read_cache(self, source):
+        if not self.cache_path or not source:
+            return None
+        try:
+            with open(self.cache_path, 'rb') as fin:
+                cached_source, types, compressible = marshal.loads(fin.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if tuple(cached_source) != source:
+            return None
+        return types, compressible
+
+    def _write_cache(self, source, compiled):
+        if not self.cache_path or not source:
+            return
+        temp_path = "%s.%d" % (self.cache_path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as fout:
+                marshal.dump((source,) + compiled, fout)
+            os.replace(temp_path, self.cache_path)
+        except (IOError, OSError) as e:
+            self.logger.warning("Can not write mime table cache: %s" % e)
+
+    @staticmethod
+    def compressible_type(mime_type):
+        """
+        Classify a mime type as text-like content worth compressing. Images,
+        audio, video and archive formats are already compressed.
+        """
+        if mime_type.startswith('text/'):
+            return True
+        if mime_type.endswith('+xml') or mime_type.endswith('+json'):
+            return True
+        return mime_type in ('application/javascript', 'application/json',
+                             'application/xml', 'application/x-sh',
+                             'application/x-csh', 'application/x-tex',
+                             'application/x-latex', 'application/rtf',
+                             'application/postscript', 'image/bmp',
+                             'image/x-ms-bmp', 'application/wasm')
+
+
+class FileIndex(object):
+    """
+    Index of the files under the resource directory, published as immutable
+    IndexSnapshot generations. A background thread re-lists only the
+    directories whose mtime changed since the previous pass and publishes
+    the new tree in one step once a pass finds no further change, so a
+    deploy in progress is never partly visible. When the resource directory
+    is a symlink switched to another release directory, the new release is
+    indexed in full and published at once.
+    """
+
+    def __init__(self, root, interval=2, on_publish=None):
+        """
+        :param root: Resource directory
+        :param interval: Seconds between two refresh passes
+        :param on_publish: Callable invoked with the previous and the new
+                           snapshot each time a generation is published
+        """
+        self.root = root
+        self.interval = interval
+        self.on_publish = on_publish
+        self.snapshot = IndexSnapshot(0, None, frozenset(), {})
+        self.scanned = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+    def __contains__(self, path):
+        return path in self.snapshot.files
+
+    def directory(self, reldir):
+        """
+        :param reldir: Directory relative to the root, '' for the root
+        :return: IndexedDir of the directory, None if it is not indexed.
+                 Entries are replaced, never modified, when the directory
+                 changes.
+        """
+        return self.snapshot.dirs.get(reldir)
+
+    def scan(self):
+        """
+        Build the index from scratch
+        """
+        if not os.path.isdir(self.root):
+            raise IOError('Resource directory "%s" does not exists. '
+                          'Exiting..' % self.root)
+        with self.lock:
+            real_root = os.path.realpath(self.root)
+            dirs = {}
+            self._scan_dir(dirs, real_root, '')
+            self._publish(real_root, dirs)
+
+    def refresh(self):
+        """
+        Re-list the directories modified since the last pass, publishing
+        the result once the tree has stopped changing
+        """
+        with self.lock:
+            real_root = os.path.realpath(self.root)
+            if real_root != self.snapshot.root:
+                dirs = {}
+                self._scan_dir(dirs, real_root, '')
+                self._publish(real_root, dirs)
+                return
+            scanned = self.scanned
+            dirs = dict(scanned)
+            for reldir in list(scanned.keys()):
+                indexed = dirs.get(reldir)
+                if indexed is None:
+                    continue
+                try:
+                    mtime = os.stat(self._abspath(real_root, reldir)).st_mtime
+                except OSError:
+                    self._remove_dir(dirs, reldir)
+                    continue
+                if mtime != indexed.mtime:
+                    self._scan_dir(dirs, real_root, reldir)
+            if dirs != scanned:
+                # Still changing: wait for a quiet pass
+                self.scanned = dirs
+            elif scanned is not self.snapshot.dirs:
+                self._publish(real_root, scanned)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="file-index")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.error(e)
+
+    def _publish(self, real_root, dirs):
+        files = frozenset(self._join(reldir, name)
+                          for reldir, indexed in dirs.items()
+                          for name in indexed.files)
+        previous = self.snapshot
+        self.scanned = dirs
+        self.snapshot = IndexSnapshot(previous.generation + 1, real_root,
+                                      files, dirs)
+        self.logger.info("Published file index generation %d: %d files" %
+                         (self.snapshot.generation, len(files)))
+        if self.on_publish:
+            self.on_publish(previous, self.snapshot)
+
+    @staticmethod
+    def _abspath(real_root, reldir):
+        return os.path.join(real_root, reldir) if reldir else real_root
+
+    @staticmethod
+    def _join(reldir, name):
+        return reldir + '/' + name if reldir else name
+
+    def _scan_dir(self, dirs, real_root, reldir):
+        """
+        List a directory and apply the difference with its indexed entries
+        """
+        try:
+            mtime = os.stat(self._abspath(real_root, reldir)).st_mtime
+            entries = list(os.scandir(self._abspath(real_root, reldir)))
+        except OSError:
+            self._remove_dir(dirs, reldir)
+            return
+        files = set()
+        subdirs = set()
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.add(entry.name)
+            elif entry.is_file():
+                files.add(entry.name)
+        old = dirs.get(reldir, IndexedDir(None, frozenset(), frozenset()))
+        dirs[reldir] = IndexedDir(mtime, frozenset(files), frozenset(subdirs))
+        for name in old.subdirs - subdirs:
+            self._remove_dir(dirs, self._join(reldir, name))
+        for name in subdirs - old.subdirs:
+            self._scan_dir(dirs, real_root, self._join(reldir, name))
+
+    def _remove_dir(self, dirs, reldir):
+        indexed = dirs.pop(reldir, None)
+        if indexed is None:
+            return
+        for name in indexed.subdirs:
+            self._remove_dir(dirs, self._join(reldir, name))
+
+
+class PackedTree(object):
+    """
+    Resource directory packed into a single archive file: the file contents
+    followed by an index of the offset, length, mtime and content type of
+    each file, with a gzip encoded copy of the compressible ones. The
+    archive is memory mapped, so a request for a packed file is answered
+    with a dictionary lookup and a slice of the mapping, without opening or
+    stat'ing anything. It stands in for the FileIndex of the directory and
+    loads the archive again when it is replaced.
+    """
+    magic = b'HTTPPACK'
+    version = 1
+    header_format = '>8sHQQ'
+
+    def __init__(self, path, date_format, interval=2, on_publish=None):
+        """
+        :param path: Archive built by PackedTree.build
+        :param date_format: strftime format of the Last-Modified dates
+        :param interval: Seconds between checks for a new archive
+        :param on_publish: Callable invoked with the previous and the new
+                           snapshot each time an archive is loaded
+        """
+        self.path = path
+        self.date_format = date_format
+        self.interval = interval
+        self.on_publish = on_publish
+        self.snapshot = IndexSnapshot(0, None, frozenset(), {})
+        # Index, built entries and mapping of the loaded archive, replaced
+        # together
+        self.contents = ({}, {}, None)
+        self.source = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+    def __contains__(self, path):
+        return path in self.snapshot.files
+
+    def directory(self, reldir):
+        return self.snapshot.dirs.get(reldir)
+
+    def get(self, requested_file, encoding=None):
+        """
+        :param encoding: 'gzip' for the compressed copy of the file
+        :return: CachedFile whose body is a slice of the mapping, None if
+                 the archive has no such file or encoding
+        """
+        index, entries, view = self.contents
+        key = (requested_file, encoding)
+        entry = entries.get(key)
+        if entry is not None:
+            return entry
+        fields = index.get(requested_file)
+        if fields is None:
+            return None
+        offset, length, mtime, content_type, gzip_offset, gzip_length = \
+            fields
+        if encoding:
+            if encoding != 'gzip' or gzip_length < 0:
+                return None
+            body = view[gzip_offset:gzip_offset + gzip_length]
+        else:
+            body = view[offset:offset + length]
+        entry = CachedFile(self.snapshot.root + '/' + requested_file,
+                           ContentStat(mtime, length),
+                           strftime(self.date_format, gmtime(mtime)),
+                           content_type, body, encoding, gzip_length >= 0)
+        entries[key] = entry
+        return entry
+
+    def load(self):
+        """
+        Map the archive and publish its index
+        """
+        stat = os.stat(self.path)
+        with open(self.path, 'rb') as fin:
+            mapping = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        header_size = struct.calcsize(self.header_format)
+        magic, version, index_offset, index_length = struct.unpack(
+            self.header_format, mapping[:header_size])
+        if magic != self.magic or version != self.version:
+            mapping.close()
+            raise IOError('"%s" is not a packed resource directory' %
+                          self.path)
+        index, dirs = marshal.loads(
+            mapping[index_offset:index_offset + index_length])
+        dirs = dict((reldir, IndexedDir(mtime, frozenset(files),
+                                        frozenset(subdirs)))
+                    for reldir, (mtime, files, subdirs) in dirs.items())
+        self.contents = (index, {}, memoryview(mapping))
+        self.source = (stat.st_ino, stat.st_mtime, stat.st_size)
+        previous = self.snapshot
+        self.snapshot = IndexSnapshot(previous.generation + 1,
+                                      os.path.realpath(self.path),
+                                      frozenset(index), dirs)
+        self.logger.info("Loaded %d packed files from %s" %
+                         (len(index), self.path))
+        if self.on_publish:
+            self.on_publish(previous, self.snapshot)
+
+    def refresh(self):
+        """
+        Load the archive again if it has been replaced
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if (stat.st_ino, stat.st_mtime, stat.st_size) != self.source:
+            self.load()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="packed-tree")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.error(e)
+
+    @classmethod
+    def build(cls, root, path, content_type, compressible, compress_level=6,
+              compress_min_size=256):
+        """
+        Pack the files under a directory into an archive. The archive is
+        written next to its final path and renamed over it, so a server
+        serving the previous archive switches to the new one in one step.
+        :param content_type: Callable returning the content type of a
+                             relative file path
+        :param compressible: Callable telling if a relative file path is
+                             worth compressing
+        :return: Number of files packed
+        """
+        if not os.path.isdir(root):
+            raise IOError('Resource directory "%s" does not exists. '
+                          'Exiting..' % root)
+        index = {}
+        dirs = {}
+        temp_path = "%s.%d" % (path, os.getpid())
+        header_size = struct.calcsize(cls.header_format)
+        with open(temp_path, 'wb') as fout:
+            fout.write(b'\0' * header_size)
+            offset = header_size
+            for top, subdirs, files in os.walk(root):
+                subdirs.sort()
+                reldir = os.path.relpath(top, root).replace(os.sep, '/')
+                reldir = '' if reldir == '.' else reldir
+                packed = []
+                for name in sorted(files):
+                    file_path = os.path.join(top, name)
+                    if not os.path.isfile(file_path):
+                        continue
+                    requested_file = reldir + '/' + name if reldir else name
+                    with open(file_path, 'rb') as fin:
+                        stat = os.fstat(fin.fileno())
+                        content = fin.read()
+                    fout.write(content)
+                    gzip_offset = gzip_length = -1
+                    if len(content) >= compress_min_size and \
+                            compressible(requested_file):
+                        compressed = gzip.compress(content, compress_level,
+                                                   mtime=0)
+                        if len(compressed) < len(content):
+                            fout.write(compressed)
+                            gzip_offset = offset + len(content)
+                            gzip_length = len(compressed)
+                    index[requested_file] = (
+                        offset, len(content), stat.st_mtime,
+                        content_type(requested_file), gzip_offset,
+                        gzip_length)
+                    offset += len(content) + max(gzip_length, 0)
+                    packed.append(name)
+                dirs[reldir] = (os.stat(top).st_mtime, packed,
+                                [name for name in subdirs
+                                 if not os.path.islink(os.path.join(top,
+                                                                    name))])
+            data = marshal.dumps((index, dirs))
+            fout.write(data)
+            fout.seek(0)
+            fout.write(struct.pack(cls.header_format, cls.magic, cls.version,
+                                   offset, len(data)))
+        os.replace(temp_path, path)
+        return len(index)
+
+
+class AccessCounter(object):
+    """
+    Per-file access counters sharded by thread. Each thread only writes its
+    own shard, so counting takes no lock; readers sum the shards.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.shards_lock = threading.Lock()
+
+    def increment(self, path):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.shards_lock:
+                self.shards.append(shard)
+        shard[path] = shard.get(path, 0) + 1
+
+    def count(self, path):
+        """
+        :return: Access count of one file summed over the shards
+        """
+        with self.shards_lock:
+            shards = list(self.shards)
+        return sum(shard.get(path, 0) for shard in shards)
+
+    def counts(self):
+        """
+        Aggregate the shards
+        :return: Dict of path to access count
+        """
+        with self.shards_lock:
+            shards = list(self.shards)
+        totals = {}
+        for shard in shards:
+            for path, count in dict(shard).items():
+                totals[path] = totals.get(path, 0) + count
+        return totals
+
+    def discard(self, paths):
+        """
+        Forget the counts of files that no longer exist. A count being
+        incremented concurrently may survive until the next call.
+        """
+        with self.shards_lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for path in paths:
+                shard.pop(path, None)
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms sharded by thread like AccessCounter,
+    so recording costs a dictionary update; scrapes aggregate the shards
+    and render them in the Prometheus text format.
+    """
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        self.shards_lock = threading.Lock()
+        self.help = {}
+        self.gauges = []
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def add_gauges(self, callback):
+        """
+        Register a callable returning a list of (name, labels, value) tuples
+        evaluated at scrape time
+        """
+        self.gauges.append(callback)
+
+    def inc(self, name, value=1, labels=''):
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, seconds):
+        histograms = self._shard()[1]
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = [[0] * (len(self.buckets) + 1), 0.0]
+        histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[1] += seconds
+
+    def counter(self, name, labels=''):
+        """
+        Aggregated value of a counter
+        """
+        return self._aggregate()[0].get((name, labels), 0)
+
+    def render(self):
+        """
+        Aggregate the shards in the Prometheus text exposition format
+        """
+        counters, histograms = self._aggregate()
+        lines = []
+        for name in sorted(set(key[0] for key in counters)):
+            self._header(lines, name, 'counter')
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(self._sample(name, labels, value))
+        for name in sorted(histograms):
+            counts, total = histograms[name]
+            self._header(lines, name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(self._sample(name + '_bucket', 'le="%s"' % bound,
+                                          cumulative))
+            lines.append("%s_sum %f" % (name, total))
+            lines.append("%s_count %d" % (name, cumulative))
+        declared = set()
+        for callback in self.gauges:
+            for name, labels, value in callback():
+                if name not in declared:
+                    self._header(lines, name, 'gauge')
+                    declared.add(name)
+                lines.append(self._sample(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name, metric_type):
+        if name in self.help:
+            lines.append("# HELP %s %s" % (name, self.help[name]))
+        lines.append("# TYPE %s %s" % (name, metric_type))
+
+    @staticmethod
+    def _sample(name, labels, value):
+        if labels:
+            return "%s{%s} %s" % (name, labels, value)
+        return "%s %s" % (name, value)
+
+    def _shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = ({}, {})
+            with self.shards_lock:
+                self.shards.append(shard)
+            return shard
+
+    def _aggregate(self):
+        with self.shards_lock:
+            shards = list(self.shards)
+        counters = {}
+        histograms = {}
+        for shard_counters, shard_histograms in shards:
+            for key, value in dict(shard_counters).items():
+                counters[key] = counters.get(key, 0) + value
+            for name, (counts, total) in dict(shard_histograms).items():
+                merged = histograms.setdefault(
+                    name, [[0] * (len(self.buckets) + 1), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], list(counts))]
+                merged[1] += total
+        return counters, histograms
+
+
+class AccessLogWriter(object):
+    """
+    Buffered access log. Request threads only append to a bounded ring
+    buffer; a background thread formats the pending entries and writes them
+    in one batch every flush interval. While the buffer is full new entries
+    are dropped and counted rather than blocking the request threads.
+    Lines are built by a format_<name> method, or by a callable taking the
+    same arguments and returning a line or None to skip the entry. Access
+    counts are kept by the server and passed with each entry.
+    """
+    formats = ('pipe', 'common')
+
+    def __init__(self, stream=None, flush_interval=0.5, capacity=65536,
+                 log_format='pipe'):
+        """
+        :param stream: Text stream written to, stdout by default
+        :param capacity: Entries buffered before new ones are dropped
+        :param log_format: Name of a format or a callable
+        """
+        self.stream = stream or sys.stdout
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.formatter = log_format if callable(log_format) else \
+            getattr(self, 'format_' + log_format)
+        self.pending = collections.deque()
+        self.written = 0
+        self.dropped = 0
+        self.overflows = 0
+        self.full = False
+        self.drop_lock = threading.Lock()
+        self.date = (None, "")
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+    def log(self, requested_file, client_ip, request=None, code=200,
+            size=0, count=0):
+        """
+        Queue an access entry
+        :param request: Request answered, None if it could not be parsed
+        :param size: Bytes of the response body
+        :param count: Times the file has been served, this response included
+        """
+        if len(self.pending) >= self.capacity:
+            with self.drop_lock:
+                if not self.full:
+                    self.full = True
+                    self.overflows += 1
+                self.dropped += 1
+            return
+        self.pending.append((time.time(), requested_file, client_ip, request,
+                             code, size, count))
+
+    def format_pipe(self, timestamp, requested_file, client_ip, request, code,
+                    size, count):
+        """
+        /file|client address|client port|times the file was served, for
+        successful responses of counted files only
+        """
+        if code not in (200, 206) or not count:
+            return None
+        return "/%s|%s|%d|%d\n" % (requested_file, client_ip[0], client_ip[1],
+                                   count)
+
+    def format_common(self, timestamp, requested_file, client_ip, request,
+                      code, size, count):
+        """
+        Common Log Format
+        """
+        second = int(timestamp)
+        if self.date[0] != second:
+            self.date = (second, strftime("%d/%b/%Y:%H:%M:%S +0000",
+                                          gmtime(second)))
+        request_line = '-'
+        if request is not None:
+            request_line = ("%s %s HTTP/%s" % (
+                request.method, request.target, request.version)).replace(
+                '\\', '\\\\').replace('"', '\\"')
+        return '%s - - [%s] "%s" %d %s\n' % (client_ip[0], self.date[1],
+                                             request_line, code, size or '-')
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="access-log")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the writer thread after writing the remaining entries
+        """
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.flush()
+
+    def flush(self):
+        lines = []
+        while self.pending:
+            line = self.formatter(*self.pending.popleft())
+            if line:
+                lines.append(line)
+        if self.full:
+            with self.drop_lock:
+                self.full = False
+        if lines:
+            self.stream.write(''.join(lines))
+            self.stream.flush()
+            self.written += len(lines)
+
+    def stats(self):
+        return {'pending': len(self.pending),
+                'written': self.written,
+                'dropped': self.dropped,
+                'overflows': self.overflows}
+
+    def _run(self):
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(e)
+
+
+class ClientLimiter(object):
+    """
+    Admission control per client address: a cap on concurrent connections
+    and a token bucket refilled at rate requests per second holding up to
+    burst tokens. Clients without open connections whose bucket is full
+    again are forgotten, so the table only holds recently active clients.
+    """
+
+    def __init__(self, rate=0, burst=0, max_connections=0, sweep_interval=10):
+        """
+        :param rate: Requests per second allowed per client, 0 for no limit
+        :param burst: Requests allowed at once above the rate
+        :param max_connections: Connections per client, 0 for no limit
+        :param sweep_interval: Seconds between two passes expiring entries
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_connections = max_connections
+        self.sweep_interval = sweep_interval
+        # Client address to [tokens, last refill time, open connections]
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.last_sweep = time.time()
+        self.rejected_connections = 0
+        self.limited_requests = 0
+
+    def connect(self, address):
+        """
+        Admit a new connection of a client
+        :return: False if the client has too many connections open
+        """
+        now = time.time()
+        with self.lock:
+            if now - self.last_sweep >= self.sweep_interval:
+                self._expire(now)
+            client = self.clients.get(address)
+            if client is None:
+                client = self.clients[address] = [self.burst, now, 0]
+            if self.max_connections and client[2] >= self.max_connections:
+                self.rejected_connections += 1
+                return False
+            client[2] += 1
+            return True
+
+    def disconnect(self, address):
+        with self.lock:
+            client = self.clients.get(address)
+            if client is not None:
+                client[2] -= 1
+
+    def allow(self, address):
+        """
+        Take a token from a client's bucket for a request
+        :return: False if the client is over its rate
+        """
+        if not self.rate:
+            return True
+        now = time.time()
+        with self.lock:
+            client = self.clients.get(address)
+            if client is None:
+                client = self.clients[address] = [self.burst, now, 0]
+            client[0] = min(self.burst,
+                            client[0] + (now - client[1]) * self.rate)
+            client[1] = now
+            if client[0] < 1:
+                self.limited_requests += 1
+                return False
+            client[0] -= 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {'clients': len(self.clients),
+                    'rejected_connections': self.rejected_connections,
+                    'limited_requests': self.limited_requests}
+
+    def _expire(self, now):
+        self.last_sweep = now
+        full = self.burst / self.rate if self.rate else 0
+        for address, client in list(self.clients.items()):
+            if client[2] <= 0 and now - client[1] >= full:
+                del self.clients[address]
+
+
+class RequestError(Exception):
+    """
+    Malformed or unsupported request, answered with the given status code
+    """
+
+    def __init__(self, code, message=''):
+        super(RequestError, self).__init__(message or str(code))
+        self.code = code
+
+
+class Request(object):
+    """
+    Parsed request line and headers
+    """
+
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = b''
+        path = target
+        if '://' in path:
+            # absolute-form target
+            path = '/' + path.split('://', 1)[1].partition('/')[2]
+        path = path.split('?', 1)[0].split('#', 1)[0]
+        self.requested_file = unquote(path)[1:]
+
+    def has_body(self):
+        return 'transfer-encoding' in self.headers or \
+            self.headers.get('content-length', '0') != '0'
+
+
+class RequestParser(object):
+    """
+    Incremental HTTP/1.x request parser. Bytes are fed as they arrive into a
+    reused buffer; complete requests are taken off the front in order, so
+    pipelined requests are parsed without re-reading what was scanned.
+    Bodies with a Content-Length are read with their request; chunked
+    request bodies are left unread.
+    """
+    request_line_re = re.compile(
+        r"([!#$%&'*+.^_`|~0-9A-Za-z-]+) (/\S*|[a-zA-Z][a-zA-Z0-9+.-]*://\S+) "
+        r"HTTP/(\d)\.(\d)$")
+    header_re = re.compile(r"([!#$%&'*+.^_`|~0-9A-Za-z-]+):[ \t]*(.*?)[ \t]*$")
+
+    def __init__(self, max_header_size=8192, max_headers=100,
+                 max_body_size=1 << 20):
+        self.max_header_size = max_header_size
+        self.max_headers = max_headers
+        self.max_body_size = max_body_size
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.started = None
+        self.request = None
+        self.body_size = 0
+
+    def feed(self, data):
+        """
+        Append received bytes to the buffer
+        """
+        if not self.buffer:
+            self.started = time.time()
+        self.buffer += data
+
+    def pending(self):
+        """
+        Check if part of a request has been received
+        """
+        return bool(self.buffer) or self.request is not None
+
+    def next_request(self):
+        """
+        Take the next complete request off the buffer
+        :return: Request, or None until the whole header and body have
+                 arrived
+        :raise RequestError: For a malformed or oversized request
+        """
+        if self.request is None:
+            # Empty lines before a request line are ignored (RFC 7230 3.5)
+            while self.buffer[:2] == b'\r\n':
+                del self.buffer[:2]
+            end = self.buffer.find(b'\r\n\r\n', max(0, self.scanned - 3))
+            if end < 0:
+                self.scanned = len(self.buffer)
+                if self.scanned > self.max_header_size:
+                    raise RequestError(431, "Request header too large")
+                return None
+            if end > self.max_header_size:
+                raise RequestError(431, "Request header too large")
+            head = self.buffer[:end].decode('latin-1')
+            del self.buffer[:end + 4]
+            self.scanned = 0
+            self.request = self._parse(head)
+            self.body_size = self._body_size(self.request.headers)
+        if len(self.buffer) < self.body_size:
+            return None
+        request = self.request
+        if self.body_size:
+            request.body = bytes(self.buffer[:self.body_size])
+            del self.buffer[:self.body_size]
+        self.request = None
+        self.started = time.time() if self.buffer else None
+        return request
+
+    def _body_size(self, headers):
+        if 'transfer-encoding' in headers:
+            return 0
+        try:
+            size = int(headers.get('content-length', 0))
+        except ValueError:
+            raise RequestError(400, "Invalid Content-Length")
+        if size < 0:
+            raise RequestError(400, "Invalid Content-Length")
+        if size > self.max_body_size:
+            raise RequestError(413, "Request body too large")
+        return size
+
+    def _parse(self, head):
+        lines = head.split('\r\n')
+        parsed_request = self.request_line_re.match(lines[0])
+        if not parsed_request:
+            raise RequestError(400, "Invalid request line %r" % lines[0])
+        method, target, major, minor = parsed_request.groups()
+        if major != '1':
+            raise RequestError(505, "Unsupported version %s.%s" %
+                               (major, minor))
+        if len(lines) - 1 > self.max_headers:
+            raise RequestError(431, "Too many request headers")
+        headers = {}
+        for line in lines[1:]:
+            header = self.header_re.match(line)
+            if not header:
+                raise RequestError(400, "Invalid header line %r" % line)
+            name = header.group(1).lower()
+            if name in headers:
+                headers[name] += ', ' + header.group(2)
+            else:
+                headers[name] = header.group(2)
+        return Request(method, target, major + '.' + minor, headers)
+
+
+class Connection(object):
+    """
+    Per-client state for the event loop engine, and for the threaded engine
+    while the connection waits for its next request
+    """
+
+    def __init__(self, client_socket, client_ip):
+        self.socket = client_socket
+        self.client_ip = client_ip
+        self.parser = None
+        self.replies = collections.deque()
+        self.served = 0
+        self.last_active = time.time()
+        self.closing = False
+        self.closed = False
+        self.handshaking = False
+
+
+class UpstreamError(RequestError):
+    """
+    Failure to get a reply from an upstream, answered with the given status
+    code
+    """
+
+
+class Upstream(object):
+    """
+    Backend server with a pool of persistent connections. At most
+    max_connections requests are in flight at once; idle connections are
+    kept for the next request instead of connecting again. The upstream is
+    taken out of rotation after max_failures failures in a row; read
+    timeouts are counted as failures but never take it out, as a slow
+    reply says nothing about the next one.
+    """
+    max_failures = 3
+
+    def __init__(self, host, port, max_connections=8, timeout=10):
+        """
+        :param timeout: Seconds allowed to connect, to wait for a free
+                        connection slot and for each read of the reply
+        """
+        self.address = (host, port)
+        self.name = "%s:%d" % (host, port)
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle = collections.deque()
+        self.active = 0
+        self.healthy = True
+        self.condition = threading.Condition()
+        self.requests = 0
+        self.failures = 0
+        self.failed_in_row = 0
+        self.connects = 0
+        self.reuses = 0
+
+    def acquire(self):
+        """
+        Take an idle connection or open a new one, waiting while the
+        connection limit is reached
+        :return: Tuple of the socket and whether it was reused
+        :raise UpstreamError: When no connection could be had in time
+        """
+        deadline = time.time() + self.timeout
+        with self.condition:
+            while self.active >= self.max_connections:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise UpstreamError(503, "Upstream %s busy" % self.name)
+                self.condition.wait(remaining)
+            self.active += 1
+            if self.idle:
+                self.reuses += 1
+                return self.idle.pop(), True
+            self.connects += 1
+        try:
+            sock = socket.create_connection(self.address, self.timeout)
+        except socket.error as e:
+            self.release(None, False)
+            self.failed(e)
+            raise UpstreamError(502, "Upstream %s: %s" % (self.name, e))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, False
+
+    def release(self, sock, reuse):
+        """
+        Return a connection to the pool, or close it
+        :param reuse: True if the connection can carry another request
+        """
+        with self.condition:
+            self.active -= 1
+            if sock is not None:
+                if reuse and len(self.idle) < self.max_connections:
+                    self.idle.append(sock)
+                else:
+                    sock.close()
+            self.condition.notify()
+
+    def succeeded(self):
+        with self.condition:
+            self.requests += 1
+            self.failed_in_row = 0
+
+    def failed(self, error):
+        """
+        Count a failed request, and take the upstream out of rotation once
+        max_failures requests in a row have failed other than by timing out
+        """
+        with self.condition:
+            self.failures += 1
+            if isinstance(error, socket.timeout):
+                return
+            self.failed_in_row += 1
+            if self.failed_in_row >= self.max_failures:
+                self.healthy = False
+
+    def check(self):
+        """
+        Health check: the upstream is healthy while it accepts connections
+        """
+        try:
+            socket.create_connection(self.address, self.timeout).close()
+        except socket.error:
+            self.healthy = False
+            return False
+        with self.condition:
+            self.failed_in_row = 0
+            self.healthy = True
+        return True
+
+    def stats(self):
+        with self.condition:
+            return {'active': self.active,
+                    'idle': len(self.idle),
+                    'healthy': int(self.healthy),
+                    'requests': self.requests,
+                    'failures': self.failures,
+                    'connects': self.connects,
+                    'reuses': self.reuses}
+
+    def close(self):
+        with self.condition:
+            while self.idle:
+                self.idle.pop().close()
+
+
+class UpstreamBody(object):
+    """
+    Reply body read from an upstream while it is relayed to the client. The
+    connection returns to the pool once the body has been read completely
+    and is closed if the relay stops early.
+    """
+    read_size = 65536
+
+    def __init__(self, upstream, sock, reply):
+        self.upstream = upstream
+        self.sock = sock
+        self.reply = reply
+        # Content-Length of the reply, None if it is chunked or delimited by
+        # the upstream closing the connection
+        self.length = reply.length
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.reply is None:
+            raise StopIteration
+        try:
+            data = self.reply.read1(self.read_size)
+            if not data and self.reply.length:
+                raise http.client.IncompleteRead(b'', self.reply.length)
+        except (socket.error, http.client.HTTPException) as e:
+            self.upstream.failed(e)
+            self.close()
+            raise IOError("Upstream %s: %s" % (self.upstream.name, e))
+        if data:
+            return data
+        self.upstream.release(self.sock, not self.reply.will_close)
+        self.reply = None
+        raise StopIteration
+
+    def close(self):
+        if self.reply is not None:
+            self.upstream.release(self.sock, False)
+            self.reply = None
+
+
+class ReverseProxy(object):
+    """
+    Route table forwarding requests to upstreams by path prefix. Each route
+    balances between its healthy upstreams by least connections; a
+    background thread checks the upstreams and brings failed ones back.
+    """
+    hop_by_hop = frozenset(['connection', 'keep-alive', 'proxy-authenticate',
+                            'proxy-authorization', 'proxy-connection', 'te',
+                            'trailer', 'transfer-encoding', 'upgrade'])
+
+    def __init__(self, routes, max_connections=8, timeout=10,
+                 health_interval=5):
+        """
+        :param routes: List of (path prefix, list of (host, port)) tuples
+        :param max_connections: Connection limit of each upstream
+        :param health_interval: Seconds between two health checks
+        """
+        upstreams = {}
+        self.routes = []
+        for prefix, addresses in routes:
+            route = []
+            for host, port in addresses:
+                if (host, port) not in upstreams:
+                    upstreams[(host, port)] = Upstream(host, port,
+                                                       max_connections,
+                                                       timeout)
+                route.append(upstreams[(host, port)])
+            self.routes.append(('/' + prefix.strip('/'), route))
+        # Longest prefix first
+        self.routes.sort(key=lambda route: len(route[0]), reverse=True)
+        self.upstreams = list(upstreams.values())
+        self.health_interval = health_interval
+        self.next_pick = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+    def match(self, request):
+        """
+        :return: Upstreams of the route the request belongs to, or None
+        """
+        path = '/' + request.requested_file
+        for prefix, upstreams in self.routes:
+            if prefix == '/' or path == prefix or \
+                    path.startswith(prefix + '/'):
+                return upstreams
+        return None
+
+    def forward(self, request, upstreams, client_ip, stream=False):
+        """
+        Send a request to the least loaded healthy upstream of its route and
+        read the reply. Upstreams that refuse the connection are skipped,
+        and a reused connection that turns out to be closed by the upstream
+        is replaced, as the request was not processed in both cases.
+        :param stream: Return after the reply header, leaving a non-empty
+                       body to be read while it is relayed
+        :return: Tuple of status code, reason, header list and body, as
+                 bytes or an UpstreamBody
+        :raise UpstreamError: When no upstream replied
+        """
+        if 'transfer-encoding' in request.headers:
+            raise UpstreamError(411, "Chunked request bodies are not proxied")
+        message = self._request_message(request, client_ip)
+        candidates = list(upstreams)
+        while True:
+            upstream = self._pick(candidates)
+            try:
+                sock, reused = upstream.acquire()
+            except UpstreamError as e:
+                if e.code != 502:
+                    raise
+                candidates.remove(upstream)
+                continue
+            try:
+                sock.sendall(message)
+                reply = http.client.HTTPResponse(sock, method=request.method)
+                reply.begin()
+                body = b''
+                if not stream or reply.length == 0:
+                    body = reply.read()
+            except (socket.error, http.client.HTTPException) as e:
+                upstream.release(sock, False)
+                if reused and isinstance(e, ConnectionError):
+                    # Closed by the upstream while idle in the pool
+                    continue
+                upstream.failed(e)
+                raise UpstreamError(502, "Upstream %s: %s" %
+                                    (upstream.name, e))
+            upstream.succeeded()
+            if stream and reply.length != 0:
+                body = UpstreamBody(upstream, sock, reply)
+            else:
+                upstream.release(sock, not reply.will_close)
+            headers = [(name, value) for name, value in reply.getheaders()
+                       if name.lower() not in self.hop_by_hop]
+            return reply.status, reply.reason, headers, body
+
+    def _pick(self, upstreams):
+        healthy = [upstream for upstream in upstreams if upstream.healthy]
+        if not healthy:
+            raise UpstreamError(503 if upstreams else 502,
+                                "No healthy upstream")
+        # Rotate the starting point so ties are spread evenly
+        self.next_pick += 1
+        start = self.next_pick % len(healthy)
+        healthy = healthy[start:] + healthy[:start]
+        return min(healthy, key=lambda upstream: upstream.active)
+
+    def _request_message(self, request, client_ip):
+        lines = ["%s %s HTTP/1.1" % (request.method, request.target)]
+        for name, value in request.headers.items():
+            if name not in self.hop_by_hop and name not in (
+                    'content-length', 'x-forwarded-for'):
+                lines.append("%s: %s" % (name, value))
+        forwarded_for = request.headers.get('x-forwarded-for')
+        lines.append("X-Forwarded-For: %s" % (
+            forwarded_for + ', ' + client_ip[0] if forwarded_for else
+            client_ip[0]))
+        if request.body or request.method in ('POST', 'PUT', 'PATCH'):
+            lines.append("Content-Length: %d" % len(request.body))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + \
+            request.body
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="health-check")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        for upstream in self.upstreams:
+            upstream.close()
+
+    def _run(self):
+        while not self.stop_event.wait(self.health_interval):
+            for upstream in self.upstreams:
+                was_healthy = upstream.healthy
+                if upstream.check() != was_healthy:
+                    self.logger.warning("Upstream %s is %s" % (
+                        upstream.name,
+                        'healthy' if upstream.healthy else 'down'))
+
+
+class PendingReply(object):
+    """
+    Place of a proxied reply in the event loop's reply queue while a proxy
+    thread waits for the upstream
+    """
+
+    def __init__(self):
+        self.response = None
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+
+
 class HTTP_Server():
 
-    status_codes = {200: '200 OK', 404: '404 Not Found'}
-    mime_types = {}
+    status_codes = {200: '200 OK', 206: '206 Partial Content',
+                    301: '301 Moved Permanently',
+                    304: '304 Not Modified', 400: '400 Bad Request',
+                    404: '404 Not Found', 405: '405 Method Not Allowed',
+                    408: '408 Request Timeout', 411: '411 Length Required',
+                    413: '413 Payload Too Large',
+                    429: '429 Too Many Requests',
+                    416: '416 Range Not Satisfiable',
+                    431: '431 Request Header Fields Too Large',
+                    500: '500 Internal Server Error',
+                    501: '501 Not Implemented', 502: '502 Bad Gateway',
+                    503: '503 Service Unavailable',
+                    505: '505 HTTP Version Not Supported'}
+    allowed_methods = ('GET', 'HEAD')
+    known_methods = ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'CONNECT',
+                     'OPTIONS', 'TRACE', 'PATCH')
+    mime_table = MimeTable()
+    content_encodings = ('gzip', 'deflate')
     default_mime_type = 'application/octet-stream'
     resource_dir = "www"
     response_status = "HTTP/1.1 {}\r\n"
     response_header_template = "Date: {}\r\nServer: {}\r\nLast-Modified: {}" +\
+                               "\r\nETag: {}\r\nAccept-Ranges: bytes" +\
                                "\r\nContent-Type: {}\r\nContent-Length: {}" +\
-                               "\r\n\n{}"
+                               "\r\n{}\r\n"
+    not_modified_template = "Date: {}\r\nServer: {}\r\nLast-Modified: {}" +\
+                            "\r\nETag: {}\r\n{}\r\n"
+    metrics_header_template = "Date: {}\r\nServer: {}\r\n" +\
+                              "Content-Type: text/plain; version=0.0.4\r\n" +\
+                              "Cache-Control: no-cache\r\n" +\
+                              "Content-Length: {}\r\n{}\r\n"
+    metric_descriptions = {
+        'http_requests_total': "Responses sent, by status code",
+        'http_response_bytes_total': "Bytes of responses sent",
+        'http_parse_seconds': "Time spent parsing a request header",
+        'http_response_build_seconds': "Time spent building a response, "
+                                       "including filesystem and cache access",
+        'http_send_seconds': "Time spent sending a response",
+        'http_connections_opened_total': "Client connections accepted",
+        'http_connections_closed_total': "Client connections closed",
+        'http_connections_active': "Client connections currently open",
+        'http_startup_seconds': "Time spent in each startup step",
+        'http_tls_handshakes_total': "Completed TLS handshakes, by whether "
+                                     "the session was resumed",
+        'http_tls_handshake_failures_total': "Failed TLS handshakes",
+        'http_upstream_seconds': "Time spent waiting for upstream replies",
+        'http_index_generation': "Generation of the published file index",
+        'http_index_files': "Files in the published file index",
+        'http_file_accesses': "Successful file responses of all the prefork "
+                              "workers, as last reported to the supervisor"}
+    unsatisfiable_range_template = "Date: {}\r\nServer: {}\r\n" +\
+                                   "Content-Range: bytes */{}\r\n" +\
+                                   "Content-Length: 0\r\n{}\r\n"
+    redirect_template = "Location: {}\r\nContent-Length: 0\r\n{}\r\n"
+    listing_page = "<html>\n<head><meta charset=\"utf-8\">" +\
+        "<title>Index of /{0}</title></head>\n<body>\n" +\
+        "<h1>Index of /{0}</h1>\n<ul>\n{1}</ul>\n</body></html>\n"
+    listing_item = "<li><a href=\"{}\">{}</a></li>\n"
+    index_file = 'index.html'
+    error_header_template = "Content-Type: text/html\r\n" +\
+                            "Content-Length: {}\r\n{}\r\n"
+    error_page = "<html>\n<title> {0} </title>\n<body><h1>{0}</h1></body>" +\
+        "</html>"
     page = "<html>\n<title> Resource not found </title>\n<body>" +\
         "<h1>404 Not Found </h1> <p> Requested resource not available.<p>" +\
         "</body></html>"
     rfc7231_date_template = "%a, %d %b %Y %H:%M:%S GMT"
+    max_header_size = 8192
+    max_body_size = 1 << 20
+    recv_size = 4096
+    header_timeout = 10
+    send_timeout = 30
+    report_interval = 1
+    max_pipeline = 16
+    max_ranges = 16
+    range_spec = re.compile(r'([0-9]*)-([0-9]*)')
+    sendfile_threshold = 65536
+    cache_max_entry = 1 << 20
+    mmap_max_entry = 64 << 20
+    compress_min_size = 256
+    compress_level = 6
     logging.basicConfig(level=logging.ERROR)
 
-    def __init__(self, host='', port=0):
+    def __init__(self, host='', port=0, workers=8, queue_size=32,
+                 queue_timeout=0, keepalive_timeout=5,
+                 max_keepalive_requests=100, cache_size=32 << 20,
+                 rescan_interval=2, compression=True, metrics_path='/metrics',
+                 mmap_size=256 << 20, access_log=None, access_log_format='pipe',
+                 access_log_buffer=65536, mime_cache=None, startup_report=False,
+                 certfile=None, keyfile=None, tls_tickets=2, listings=False,
+                 proxy_routes=None, upstream_connections=8,
+                 upstream_timeout=10, health_interval=5, backlog=128, rate=0,
+                 burst=0, max_client_connections=0, pack=None):
+        started = time.perf_counter()
+        self.startup_times = collections.OrderedDict()
+        self.startup_report = startup_report
+        if mime_cache:
+            self.mime_table = MimeTable(cache_path=mime_cache)
         self.host = host
         self.port = port
-        self.server_name = 'HTTP Server/Python 2.7'
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_keepalive_requests = max_keepalive_requests
+        self.pool = None
+        self.cache = None
+        if cache_size > 0:
+            self.cache = ResponseCache(cache_size,
+                                       min(cache_size, self.cache_max_entry))
+        self.mapped_files = None
+        if mmap_size > 0 and not certfile:
+            # SSL_write copies the mapping in userspace, see MappedFiles
+            self.mapped_files = MappedFiles(mmap_size,
+                                            min(mmap_size, self.mmap_max_entry))
+        self.server_name = 'HTTP Server/Python %d.%d' % sys.version_info[:2]
+        self.dates = DateHeader(self.server_name,
+                                self.rfc7231_date_template)
+        self.ok_status = self.response_status.format(
+            self.status_codes[200]).encode('ascii')
         self.logger = logging.getLogger(__name__)
-        self.file_access_count = {}
-        # self._set_files()
-        self._set_mime_types()
-
-    def listen(self, client_socket, client_ip):
-        """
-        Serve the request to client
-        :param client_socket: Socket object for client
-        :param client_ip: IP address of client
-        """
-        self.logger.info("Connection request from client %s" %
-                         str(client_ip))
-        msg = client_socket.recv(1024).decode('ascii')
-
-        parsed_request = re.search(r'GET /(.+) HTTP/1..*', msg)
-        if parsed_request:
-            requested_file = parsed_request.group(1)
-            self.logger.debug("Requested file from client: %s" %
-                              requested_file)
-            reply = self._make_response(**{'requested_file': requested_file})
-            self.logger.debug('Reply message : %s' % reply[:50])
-            bytes_sent = client_socket.send(reply)
-            self.logger.debug("Bytes sent: %s" % bytes_sent)
-            client_socket.close()
-            if self.status_codes[404] not in reply:
-                # If file file found, check thread lock for file
-                with self.file_access_count[requested_file][0]:
-                    count = self.file_access_count[requested_file][1] + 1
-                    self.file_access_count[requested_file][1] = count
-                    print("/%s|%s|%d|%d" % (requested_file, client_ip[0],
-                                            client_ip[1], count))
+        self.file_access_count = AccessCounter()
+        stream = None
+        if access_log and access_log != '-':
+            stream = open(access_log, 'a', buffering=1 << 16)
+        self.access_log = AccessLogWriter(stream, capacity=access_log_buffer,
+                                          log_format=access_log_format)
+        self.worker_counts = {}
+        self.metrics_path = metrics_path.lstrip('/')
+        self.metrics = Metrics()
+        self.metrics.add_gauges(self._gauges)
+        for name, text in self.metric_descriptions.items():
+            self.metrics.describe(name, text)
+        self.rescan_interval = rescan_interval
+        self.compression = compression
+        self.file_index = None
+        self.pack = pack
+        self.listings = listings
+        self.listing_cache = {}
+        self.proxy = None
+        if proxy_routes:
+            self.proxy = ReverseProxy(proxy_routes, upstream_connections,
+                                      upstream_timeout, health_interval)
+        self.proxy_pool = None
+        self.proxy_done = collections.deque()
+        self.wake_reader = self.wake_writer = None
+        self.parked = None
+        self.park_reader = self.park_writer = None
+        self.backlog = backlog
+        self.limiter = None
+        if rate > 0 or max_client_connections > 0:
+            self.limiter = ClientLimiter(rate, burst or max(1, int(rate)),
+                                         max_client_connections)
+        self.tls_context = None
+        if certfile:
+            self.tls_context = self._tls_context(certfile, keyfile,
+                                                 tls_tickets)
+        self.startup_times['init'] = time.perf_counter() - started
+
+    def listen(self, conn, request):
+        """
+        Serve the requests a client has sent, then hand the connection back
+        to the accepting thread to wait for the next one
+        :param conn: Connection of the client
+        :param request: First complete Request buffered for the connection
+        """
+        client_socket = conn.socket
+        client_ip = conn.client_ip
+        keep_open = False
+        try:
+            client_socket.settimeout(self.send_timeout)
+            while request is not None:
+                response, keep_alive = self._handle_request(request,
+                                                            conn.served,
+                                                            client_ip)
+                conn.served += 1
+                self.logger.debug('Reply message : %s' %
+                                  response.header[:50])
+                started = time.perf_counter()
+                try:
+                    response.send_blocking(client_socket, self.send_timeout)
+                finally:
+                    response.close()
+                self._complete(response, client_ip,
+                               time.perf_counter() - started)
+                if not keep_alive:
+                    return
+                started = time.perf_counter()
+                try:
+                    request = conn.parser.next_request()
+                except RequestError as e:
+                    self.logger.warning("Invalid request from client: %s" % e)
+                    self._send_error(client_socket, client_ip, e.code)
+                    return
+                if request is not None:
+                    self.metrics.observe('http_parse_seconds',
+                                         time.perf_counter() - started)
+            keep_open = True
+        except socket.timeout:
+            self.logger.debug("Send timed out for client %s" %
+                              str(client_ip))
+        except socket.error as e:
+            self.logger.warning(e)
+        finally:
+            if keep_open:
+                self._park(conn)
+            else:
+                self._close_connection(None, conn)
+
+    def _park(self, conn):
+        """
+        Return a connection whose buffered requests are all answered to the
+        accepting thread, which waits for the next request in its selector
+        """
+        self.parked.append(conn)
+        try:
+            self.park_writer.send(b'\0')
+        except socket.error:
+            # The server is stopping
+            self._close_connection(None, conn)
+
+    def _tls_context(self, certfile, keyfile, tickets):
+        """
+        Server side TLS context. Sessions are resumed from the context's
+        session cache for TLS 1.2 and from session tickets for TLS 1.3; the
+        ticket keys are generated with the context, so prefork workers
+        created from this process all accept each other's tickets.
+        :param tickets: Session tickets sent after a full TLS 1.3 handshake
+        """
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile, keyfile)
+        context.options &= ~ssl.OP_NO_TICKET
+        if hasattr(context, 'num_tickets'):
+            context.num_tickets = tickets
+        context.set_alpn_protocols(['http/1.1'])
+        return context
+
+    def _tls_handshake(self, client_socket):
+        """
+        Complete the TLS handshake of a connection within header_timeout
+        :return: The TLS socket
+        """
+        client_socket.settimeout(self.header_timeout)
+        tls_socket = self.tls_context.wrap_socket(
+            client_socket, server_side=True, do_handshake_on_connect=False)
+        try:
+            tls_socket.do_handshake()
+        except BaseException:
+            tls_socket.close()
+            raise
+        self._handshake_done(tls_socket)
+        return tls_socket
+
+    def _handshake_done(self, tls_socket):
+        self.metrics.inc('http_tls_handshakes_total',
+                         labels='resumed="%s"' %
+                         str(tls_socket.session_reused).lower())
+
+    def _complete(self, response, client_ip, send_time):
+        """
+        Account for a response that has been sent completely
+        """
+        self._record_access(response, client_ip)
+        self.metrics.inc('http_requests_total',
+                         labels='code="%d"' % response.code)
+        self.metrics.inc('http_response_bytes_total', response.size)
+        self.metrics.observe('http_send_seconds', send_time)
+
+    def _handle_request(self, request, served, client_ip, streaming=True):
+        """
+        Build the reply for one request
+        :param request: Parsed Request
+        :param served: Number of requests already answered on the connection
+        :param client_ip: Address of the client
+        :param streaming: Allow bodies that are read from an upstream while
+                          they are sent
+        :return: Tuple of the response and whether the connection stays open
+        """
+        requested_file = request.requested_file
+        # HTTP/1.0 clients do not understand the chunked transfer coding
+        chunked = request.version == '1.1'
+        self.logger.debug("%s request from client: %s" %
+                          (request.method, requested_file))
+        upstreams = self.proxy.match(request) if self.proxy else None
+        if self.limiter and not self.limiter.allow(client_ip[0]):
+            keep_alive = self._reusable(request, served)
+            response = self._error_response(429, self._connection_header(
+                keep_alive, self.max_keepalive_requests - served - 1))
+        elif upstreams is not None:
+            keep_alive = self._reusable(request, served)
+            response = self._proxy_response(request, upstreams, client_ip,
+                                            keep_alive, served,
+                                            streaming and chunked)
+        elif request.method not in self.allowed_methods:
+            # Chunked request bodies are not read, so the connection is not
+            # reused after refusing the method
+            code = 405 if request.method in self.known_methods else 501
+            response = self._error_response(code)
+            response.request = request
+            return response, False
         else:
-            self.logger.warning("Invalid request from client.")
-            self.logger.warning(msg)
+            keep_alive = self._keep_alive(request.version,
+                                          request.headers) and \
+                not request.has_body() and \
+                served + 1 < self.max_keepalive_requests
+            if self.metrics_path and requested_file == self.metrics_path:
+                response = self._metrics_response(keep_alive, served)
+            else:
+                started = time.perf_counter()
+                response = self._make_response(
+                    **{'requested_file': requested_file,
+                       'keep_alive': keep_alive,
+                       'remaining': self.max_keepalive_requests - served - 1,
+                       'headers': request.headers,
+                       'chunked': chunked})
+                self.metrics.observe('http_response_build_seconds',
+                                     time.perf_counter() - started)
+        if response.requested_file is None:
+            response.requested_file = requested_file
+        response.request = request
+        if request.method == 'HEAD':
+            response.drop_body()
+        return response, keep_alive
+
+    def _reusable(self, request, served):
+        """
+        Check if the connection can carry another request after this one,
+        whose body has been read unless it is chunked
+        """
+        return self._keep_alive(request.version, request.headers) and \
+            'transfer-encoding' not in request.headers and \
+            served + 1 < self.max_keepalive_requests
+
+    def _proxy_response(self, request, upstreams, client_ip, keep_alive,
+                        served, stream=False):
+        """
+        Forward a request to its route's upstreams and relay the reply
+        :param stream: Relay the reply body while it is read from the
+                       upstream, with the chunked transfer coding when the
+                       upstream did not give its length
+        """
+        connection = self._connection_header(
+            keep_alive, self.max_keepalive_requests - served - 1)
+        started = time.perf_counter()
+        try:
+            status, reason, headers, body = self.proxy.forward(
+                request, upstreams, client_ip, stream)
+        except UpstreamError as e:
+            self.logger.warning("Proxying %s failed: %s" % (request.target, e))
+            return self._error_response(e.code, connection)
+        finally:
+            self.metrics.observe('http_upstream_seconds',
+                                 time.perf_counter() - started)
+        streamed = isinstance(body, UpstreamBody)
+        if streamed and body.length is None:
+            headers.append(('Transfer-Encoding', 'chunked'))
+        elif not streamed and request.method != 'HEAD' and status >= 200 \
+                and status not in (204, 304):
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'content-length']
+            headers.append(('Content-Length', str(len(body))))
+        header = "HTTP/1.1 %d %s\r\n%s%s\r\n" % (
+            status, reason, ''.join("%s: %s\r\n" % field for field in headers),
+            connection)
+        if not streamed:
+            return Response(status, header.encode('latin-1'), body)
+        response = Response(status, header.encode('latin-1'))
+        response.add_stream(body, body.length is None)
+        return response
+
+    def _proxy_work(self, request, conn, reply, served):
+        """
+        Proxy thread task of the event loop: fill in a pending reply and
+        wake the loop up to send it
+        """
+        try:
+            # Upstream reads would block the event loop while sending
+            reply.response = self._handle_request(request, served,
+                                                  conn.client_ip, False)[0]
+        except Exception as e:
+            self.logger.error(e)
+            reply.response = self._error_response(502)
+        self.proxy_done.append(conn)
+        try:
+            self.wake_writer.send(b'\0')
+        except socket.error:
+            pass
+
+    def _metrics_response(self, keep_alive, served):
+        """
+        Create the response of the metrics endpoint
+        """
+        body = self.metrics.render().encode('utf-8')
+        connection = self._connection_header(
+            keep_alive, self.max_keepalive_requests - served - 1)
+        response = self.response_status.format(self.status_codes[200]) + \
+            self.metrics_header_template.format(
+                self.dates.value(),
+                self.server_name, len(body), connection)
+        response = Response(200, response.encode('ascii'), body)
+        response.counted = False
+        return response
+
+    def _gauges(self):
+        """
+        Connection, cache and worker pool gauges for the metrics endpoint
+        """
+        gauges = [('http_connections_active', '',
+                   self.metrics.counter('http_connections_opened_total') -
+                   self.metrics.counter('http_connections_closed_total'))]
+        if self.cache:
+            for name, value in sorted(self.cache.stats().items()):
+                gauges.append(('http_cache_' + name, '', value))
+        if self.mapped_files:
+            for name, value in sorted(self.mapped_files.stats().items()):
+                gauges.append(('http_mmap_' + name, '', value))
+        for phase, seconds in self.startup_times.items():
+            gauges.append(('http_startup_seconds', 'phase="%s"' % phase,
+                           seconds))
+        if self.tls_context:
+            for name, value in sorted(
+                    self.tls_context.session_stats().items()):
+                gauges.append(('http_tls_session_' + name, '', value))
+        if self.limiter:
+            for name, value in sorted(self.limiter.stats().items()):
+                gauges.append(('http_limiter_' + name, '', value))
+        if self.proxy:
+            upstream_stats = [(upstream.name, upstream.stats())
+                              for upstream in self.proxy.upstreams]
+            for name in sorted(upstream_stats[0][1] if upstream_stats else []):
+                for upstream, stats in upstream_stats:
+                    gauges.append(('http_upstream_' + name,
+                                   'upstream="%s"' % upstream, stats[name]))
+        gauges.append(('http_file_accesses', '',
+                       sum(self.access_counts().values())))
+        if self.file_index:
+            snapshot = self.file_index.snapshot
+            gauges.append(('http_index_generation', '', snapshot.generation))
+            gauges.append(('http_index_files', '', len(snapshot.files)))
+        for name, value in sorted(self.access_log.stats().items()):
+            gauges.append(('http_access_log_' + name, '', value))
+        if self.pool:
+            for name, value in sorted(self.pool.stats().items()):
+                gauges.append(('http_pool_' + name, '', value))
+        return gauges
+
+    def _error_response(self, code, connection="Connection: close\r\n"):
+        """
+        Create a short HTML response for an error status
+        """
+        status = self.status_codes[code]
+        page = self.error_page.format(status)
+        extra = ""
+        if code == 405:
+            extra = "Allow: %s\r\n" % ', '.join(self.allowed_methods)
+        elif code == 429:
+            extra = "Retry-After: 1\r\n"
+        response = self.response_status.format(status) + \
+            self.error_header_template.format(len(page), extra + connection)
+        return Response(code, response.encode('ascii'), page.encode('ascii'))
+
+    def _send_error(self, client_socket, client_ip, code):
+        """
+        Send an error response on a connection that is about to be closed
+        and account for it like any other response
+        """
+        response = self._error_response(code)
+        started = time.perf_counter()
+        try:
+            client_socket.settimeout(self.send_timeout)
+            response.send_blocking(client_socket, self.send_timeout)
+        except (socket.error, IOError):
+            return
+        self._complete(response, client_ip, time.perf_counter() - started)
+
+    @staticmethod
+    def _keep_alive(version, headers):
+        """
+        Check if the client wants the connection kept open after the reply
+        """
+        connection = headers.get('connection', '').lower()
+        if version == '1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    def _connection_header(self, keep_alive, remaining):
+        if keep_alive:
+            return "Connection: keep-alive\r\nKeep-Alive: timeout=%d, " \
+                "max=%d\r\n" % (self.keepalive_timeout, remaining)
+        return "Connection: close\r\n"
+
+    def _record_access(self, response, client_ip):
+        """
+        Increment access count of a served file and log the access with the
+        count, so the log and access_counts() never disagree
+        """
+        count = 0
+        if response.counted and response.code in (200, 206):
+            self.file_access_count.increment(response.requested_file)
+            count = self.file_access_count.count(response.requested_file)
+            for worker_counts in self.worker_counts.values():
+                count += worker_counts.get(response.requested_file, 0)
+        self.access_log.log(response.requested_file, client_ip,
+                            response.request, response.code,
+                            response.size - len(response.header), count)
+
+    def access_counts(self):
+        """
+        Number of times each file has been served, including the counts
+        reported by prefork worker processes, or in a worker the counts of
+        the other workers published by the supervisor
+        :return: Dict of requested file to count
+        """
+        counts = self.file_access_count.counts()
+        for worker_counts in self.worker_counts.values():
+            for path, count in worker_counts.items():
+                counts[path] = counts.get(path, 0) + count
+        return counts
 
     def _make_response(self, **kwargs):
         """
-        Create response header for requested file
+        Create response header for requested file. Files are served from the
+        response cache when possible; uncached files smaller than
+        sendfile_threshold are read into the response, larger ones are
+        streamed from the open file when the response is sent. Conditional
+        requests matching the current version get 304 without a body.
+        Compressible files are sent gzip or deflate encoded when the client
+        accepts it. Directories are answered with their index.html, or a
+        listing when enabled. The request is resolved against the file index
+        generation published when it started.
+        :return: Response object
         """
         requested_file = kwargs['requested_file']
-        file_path = os.path.join(self.resource_dir, requested_file)
-        response = ""
-        file_content = ""
-        if os.path.exists(file_path):
-            with open(file_path, 'rb') as fin:
-                file_content = fin.read()
-            response_code = self.status_codes[200]
-        else:
-            error_response_header = "Content-Type: text/html\r\n" +\
-                                    "Content-Length: {}\r\n\n{}"
-            response = self.response_status.format(self.status_codes[404]) +\
-                error_response_header.format(len(self.page), self.page)
+        headers = kwargs.get('headers', {})
+        connection = self._connection_header(kwargs.get('keep_alive', False),
+                                             kwargs.get('remaining', 0))
+        entry = None
+        fin = None
+        snapshot = self.file_index.snapshot
+        if requested_file not in snapshot.files:
+            reldir = requested_file.rstrip('/')
+            directory = snapshot.dirs.get(reldir)
+            if directory is not None:
+                if requested_file and not requested_file.endswith('/'):
+                    return self._redirect('/' + requested_file + '/',
+                                          connection)
+                if self.index_file in directory.files:
+                    # Accounted under the file actually served
+                    index_file = (reldir + '/' if reldir else '') + \
+                        self.index_file
+                    response = self._make_response(
+                        **dict(kwargs, requested_file=index_file))
+                    response.requested_file = index_file
+                    return response
+                elif self.listings:
+                    response = self._entry_response(
+                        self._listing(snapshot, reldir, directory), None,
+                        headers, connection)
+                    response.counted = False
+                    return response
+        file_path = os.path.join(snapshot.root, requested_file)
+        if entry is None and self.pack:
+            entry = self._packed_entry(requested_file, headers)
+            if entry is None:
+                return self._not_found(connection)
+        if entry is None and self.compression and 'range' not in headers and \
+                self._compressible(requested_file):
+            encoding = self._negotiate_encoding(
+                headers.get('accept-encoding', ''))
+            if encoding:
+                entry, fin = self._encoded_variant(
+                    snapshot, requested_file, file_path, encoding,
+                    kwargs.get('chunked', False))
+        if entry is None and self.cache:
+            entry = self.cache.get(file_path)
+        if entry is None and self.mapped_files:
+            entry = self.mapped_files.get(file_path)
+        if entry is None:
+            if requested_file not in snapshot.files:
+                return self._not_found(connection)
+            try:
+                fin = open(file_path, 'rb')
+            except (IOError, OSError):
+                # Removed since the last index refresh
+                return self._not_found(connection)
+            entry = self._load_file(fin, file_path, requested_file)
+        return self._entry_response(entry, fin, headers, connection)
+
+    def _entry_response(self, entry, fin, headers, connection):
+        """
+        Create the response serving an entry: 304 when the client's copy is
+        current, the requested ranges, or the whole body
+        :param fin: File the body is sent from when it is not in memory
+        """
+        date = self.dates.value()
+        if entry.not_modified(headers):
+            if fin:
+                fin.close()
+            response = self.not_modified_template.format(date,
+                                                         self.server_name,
+                                                         entry.last_modified,
+                                                         entry.etag,
+                                                         connection)
+            response = self.response_status.format(self.status_codes[304]) +\
+                response
+            return Response(304, response.encode('ascii'))
+
+        ranges = None
+        if 'range' in headers and entry.if_range(headers):
+            ranges = self._parse_ranges(headers['range'], entry.length)
+        if ranges == []:
+            if fin:
+                fin.close()
+            response = self.unsatisfiable_range_template.format(
+                date, self.server_name, entry.length, connection)
+            response = self.response_status.format(self.status_codes[416]) +\
+                response
+            return Response(416, response.encode('ascii'))
+        if ranges:
+            return self._partial_response(date, entry, fin, ranges,
+                                          connection)
+
+        header = b''.join((self.ok_status, self.dates.fields(),
+                           entry.header_fields, connection.encode('ascii'),
+                           b'\r\n'))
+        if entry.length is None:
+            response = Response(200, header, fin=fin)
+            response.add_stream(self._compress_stream(fin, entry.encoding))
             return response
+        if entry.body is None:
+            return Response(200, header, fin=fin, count=entry.length)
+        return Response(200, header, entry.body)
 
-        date = strftime(self.rfc7231_date_template, gmtime())
-        modified_date = gmtime(os.path.getmtime(file_path))
-        last_modified_date = strftime(self.rfc7231_date_template, modified_date)
-        file_ext = requested_file.split('.')[-1]
-        if file_ext in self.mime_types.keys():
-            content_type = self.mime_types[file_ext]
+    def _partial_response(self, date, entry, fin, ranges, connection):
+        """
+        Create a 206 response carrying the requested byte ranges, as a
+        multipart/byteranges body when there is more than one
+        :param ranges: List of (first, last) byte positions
+        """
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            content_type = entry.content_type
+            content_range = "Content-Range: bytes %d-%d/%d\r\n" % \
+                (first, last, entry.length)
+            content_length = last - first + 1
+            parts = [(None, first, last)]
+            closing = b''
         else:
-            content_type = self.default_mime_type
-        content_length = os.path.getsize(file_path)
+            boundary = binascii.hexlify(os.urandom(8)).decode('ascii')
+            content_type = "multipart/byteranges; boundary=" + boundary
+            content_range = ""
+            parts = []
+            content_length = 0
+            for first, last in ranges:
+                part_header = ("\r\n--%s\r\nContent-Type: %s\r\n"
+                               "Content-Range: bytes %d-%d/%d\r\n\r\n" %
+                               (boundary, entry.content_type, first, last,
+                                entry.length)).encode('ascii')
+                parts.append((part_header, first, last))
+                content_length += len(part_header) + last - first + 1
+            closing = ("\r\n--%s--\r\n" % boundary).encode('ascii')
+            content_length += len(closing)
 
         response = self.response_header_template.format(date, self.server_name,
-                                                        last_modified_date,
+                                                        entry.last_modified,
+                                                        entry.etag,
                                                         content_type,
                                                         content_length,
-                                                        file_content)
-        return self.response_status.format(response_code) + response
+                                                        content_range +
+                                                        entry.extra_headers +
+                                                        connection)
+        response = self.response_status.format(self.status_codes[206]) + \
+            response
+        reply = Response(206, response.encode('ascii'), fin=fin)
+        for part_header, first, last in parts:
+            if part_header:
+                reply.add(part_header)
+            if entry.body is None:
+                reply.add_file_range(first, last - first + 1)
+            else:
+                reply.add(memoryview(entry.body)[first:last + 1])
+        reply.add(closing)
+        return reply
+
+    def _parse_ranges(self, value, size):
+        """
+        Parse a Range header against a resource of the given size
+        :return: List of (first, last) byte positions, an empty list if no
+                 range is satisfiable, or None if the header should be
+                 ignored and the whole resource sent
+        """
+        unit, _, specs = value.partition('=')
+        if unit.strip().lower() != 'bytes':
+            return None
+        specs = specs.split(',')
+        if len(specs) > self.max_ranges:
+            return None
+        ranges = []
+        for spec in specs:
+            match = self.range_spec.fullmatch(spec.strip())
+            if match is None or match.group(0) == '-':
+                return None
+            first, last = match.groups()
+            if not first:
+                suffix = int(last)
+                if suffix <= 0 or size == 0:
+                    continue
+                ranges.append((max(0, size - suffix), size - 1))
+                continue
+            first = int(first)
+            last = int(last) if last else None
+            if last is None:
+                last = size - 1
+            elif first > last:
+                return None
+            if first < size:
+                ranges.append((first, min(last, size - 1)))
+        return ranges
+
+    def _redirect(self, path, connection):
+        response = self.response_status.format(self.status_codes[301]) +\
+            self.redirect_template.format(quote(path), connection)
+        return Response(301, response.encode('ascii'))
+
+    def _listing(self, snapshot, reldir, directory):
+        """
+        Listing page of an indexed directory, generated from the file index
+        and reused until the index entry of the directory is replaced
+        :param directory: IndexedDir of the directory
+        :return: CachedFile
+        """
+        cached = self.listing_cache.get(reldir)
+        if cached is not None and cached[0] is directory:
+            return cached[1]
+        names = [name + '/' for name in sorted(directory.subdirs)] + \
+            sorted(directory.files)
+        if reldir:
+            names.insert(0, '../')
+        items = ''.join(self.listing_item.format(
+            quote(name, errors='surrogateescape'), html.escape(name))
+            for name in names)
+        body = self.listing_page.format(html.escape(reldir), items).encode(
+            'utf-8', 'surrogateescape')
+        entry = CachedFile(os.path.join(snapshot.root, reldir),
+                           ContentStat(directory.mtime, len(body)),
+                           strftime(self.rfc7231_date_template,
+                                    gmtime(directory.mtime)),
+                           'text/html; charset=utf-8', body)
+        self.listing_cache[reldir] = (directory, entry)
+        return entry
+
+    def _not_found(self, connection):
+        response = self.response_status.format(self.status_codes[404]) +\
+            self.error_header_template.format(len(self.page), connection)
+        return Response(404, response.encode('ascii'),
+                        self.page.encode('ascii'))
+
+    def _load_file(self, fin, file_path, requested_file, encoding=None):
+        """
+        Build the response fields of an open file. The body is read and the
+        entry cached if it fits the response cache, files up to
+        mmap_max_entry are memory mapped, and bigger ones are sent with
+        sendfile, in which case fin is left open for the response.
+        :param encoding: Content-Encoding of the file contents, for
+                         precompressed siblings of the requested file
+        :return: CachedFile
+        """
+        stat = os.fstat(fin.fileno())
+        modified_date = gmtime(stat.st_mtime)
+        last_modified_date = strftime(self.rfc7231_date_template, modified_date)
+        content_type = self._content_type(requested_file)
+        vary = self.compression and self._compressible(requested_file)
+        cacheable = self.cache and stat.st_size <= self.cache.max_entry_bytes
+        if not cacheable and not encoding and self.mapped_files and \
+                Response.chunk_size <= stat.st_size <= \
+                self.mapped_files.max_entry_bytes:
+            with fin:
+                return self.mapped_files.map(fin, file_path, stat,
+                                             last_modified_date, content_type,
+                                             vary)
+        if not cacheable and stat.st_size >= self.sendfile_threshold:
+            return CachedFile(file_path, stat, last_modified_date,
+                              content_type, None, encoding, vary)
+        with fin:
+            entry = CachedFile(file_path, stat, last_modified_date,
+                               content_type, fin.read(stat.st_size), encoding,
+                               vary)
+        if cacheable and not encoding and len(entry.body) == entry.size:
+            self.cache.put(entry)
+        return entry
+
+    def _encoded_variant(self, snapshot, requested_file, file_path,
+                         encoding, chunked=False):
+        """
+        Find or build the encoded variant of a file: from the cache, from a
+        precompressed .gz sibling at least as new as the file, or by
+        compressing the file once and caching the result. Files too large
+        for the cache are compressed while they are sent, with the chunked
+        transfer coding.
+        :param chunked: True if the client accepts the chunked coding
+        :return: Tuple of CachedFile and the open file it is sent from, or
+                 (None, None) to send the file unencoded
+        """
+        if self.cache:
+            entry = self.cache.get((file_path, encoding))
+            if entry is not None:
+                return entry, None
+        if requested_file not in snapshot.files:
+            return None, None
+        try:
+            stat = os.stat(file_path)
+            if encoding == 'gzip' and requested_file + '.gz' in \
+                    snapshot.files and \
+                    os.stat(file_path + '.gz').st_mtime >= stat.st_mtime:
+                fin = open(file_path + '.gz', 'rb')
+                entry = self._load_file(fin, file_path + '.gz', requested_file,
+                                        encoding)
+                entry.source = (file_path, stat.st_mtime, stat.st_size)
+                if entry.body is None:
+                    return entry, fin
+                if self.cache and len(entry.body) == entry.size:
+                    self.cache.put(entry, (file_path, encoding))
+                return entry, None
+            if stat.st_size < self.compress_min_size:
+                return None, None
+            if not self.cache or stat.st_size > self.cache.max_entry_bytes:
+                if not chunked:
+                    return None, None
+                fin = open(file_path, 'rb')
+                stat = os.fstat(fin.fileno())
+                entry = CachedFile(file_path, stat,
+                                   strftime(self.rfc7231_date_template,
+                                            gmtime(stat.st_mtime)),
+                                   self._content_type(requested_file), None,
+                                   encoding, chunked=True)
+                return entry, fin
+            with open(file_path, 'rb') as fin:
+                stat = os.fstat(fin.fileno())
+                content = fin.read(stat.st_size)
+        except (IOError, OSError):
+            return None, None
+        if encoding == 'gzip':
+            body = gzip.compress(content, self.compress_level, mtime=0)
+        else:
+            body = zlib.compress(content, self.compress_level)
+        if len(body) >= len(content):
+            return None, None
+        modified_date = gmtime(stat.st_mtime)
+        entry = CachedFile(file_path, stat,
+                           strftime(self.rfc7231_date_template, modified_date),
+                           self._content_type(requested_file), body, encoding)
+        self.cache.put(entry, (file_path, encoding))
+        return entry, None
+
+    def _packed_entry(self, requested_file, headers):
+        """
+        Look up a file of the packed resource directory, preferring its
+        gzip encoded copy when the client accepts it
+        :return: CachedFile or None
+        """
+        if self.compression and 'range' not in headers and \
+                self._negotiate_encoding(
+                    headers.get('accept-encoding', '')) == 'gzip':
+            entry = self.file_index.get(requested_file, 'gzip')
+            if entry is not None:
+                return entry
+        return self.file_index.get(requested_file)
+
+    def _compress_stream(self, fin, encoding):
+        """
+        Compress an open file a chunk at a time while it is sent. The file
+        is closed with the response.
+        """
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                      31 if encoding == 'gzip' else 15)
+        while True:
+            data = fin.read(Response.chunk_size)
+            if not data:
+                break
+            yield compressor.compress(data)
+        yield compressor.flush()
 
-    def _set_mime_types(self):
+    def _negotiate_encoding(self, accept_encoding):
         """
-        Parse /etc/mime.types file for each file extension
+        Pick the preferred supported encoding from an Accept-Encoding header
+        :return: Encoding name or None for identity
         """
-        with open('/etc/mime.types') as fin:
-            for line in fin.readlines():
-                if '\t' in line:
-                    mime_type, ext_list = re.sub(r'\t+', '@', line).split('@')
-                    for ext in ext_list.split():
-                        self.mime_types[ext] = mime_type
+        best = None
+        best_q = 0
+        for item in accept_encoding.split(','):
+            coding, _, params = item.partition(';')
+            coding = coding.strip().lower()
+            if coding not in self.content_encodings:
+                continue
+            q = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    continue
+            if q <= 0:
+                # q=0 means the coding is not acceptable
+                continue
+            if q > best_q or (q == best_q and best is not None and
+                              self.content_encodings.index(coding) <
+                              self.content_encodings.index(best)):
+                best = coding
+                best_q = q
+        return best
+
+    def _content_type(self, requested_file):
+        file_ext = requested_file.rpartition('.')[2]
+        return self.mime_table.get(file_ext, self.default_mime_type)
+
+    def _compressible(self, requested_file):
+        return self._content_type(requested_file) in \
+            self.mime_table.compressible
+
+    def _timed(self, phase, func, *args):
+        """
+        Run a startup step and record how long it took
+        """
+        started = time.perf_counter()
+        result = func(*args)
+        self.startup_times[phase] = time.perf_counter() - started
+        return result
+
+    def _report_startup(self):
+        report = ', '.join("%s %.2f ms" % (phase, 1000 * seconds)
+                           for phase, seconds in self.startup_times.items())
+        self.logger.info("Startup time: %s" % report)
+        if self.startup_report:
+            print("Startup time (pid %d): %s" % (os.getpid(), report))
 
     def _set_files(self):
         """
-        Get info for all the files vailabel in resource directory.
+        Index all the files available in resource directory and keep the
+        index updated in the background.
         """
+        if self.pack:
+            self.file_index = PackedTree(self.pack,
+                                         self.rfc7231_date_template,
+                                         self.rescan_interval,
+                                         self._index_published)
+            self.file_index.load()
+            self.file_index.start()
+            return
         if not os.path.exists(self.resource_dir):
             raise IOError('Resource directory "www" does not exists. Exiting..')
 
-        for root, dirs, files in os.walk(self.resource_dir):
-            for fname in files:
-                f = os.path.join(root, fname).split("/", 1)[1]
-                if f not in self.file_access_count.keys():
-                    self.file_access_count[f] = [threading.Lock(), 0]
-
-    def run_server(self):
-        """
-        Start the server on random port and assign thread to each client request.
-        """
-        try:
-            threads = []
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_socket.bind((self.host, self.port))
-            self.host = socket.gethostbyaddr(socket.gethostname())[0]
-            self.port = server_socket.getsockname()[1]
-            self.logger.debug("Server bind at address %s:%s." %
-                              (self.host, self.port))
-            print("Server is started on %s:%s" % (self.host, self.port))
-            self._set_files()
-            server_socket.listen(5)
-            self.logger.info("Server listening at %s:%s" %
-                             (self.host, self.port))
+        self.file_index = FileIndex(self.resource_dir, self.rescan_interval,
+                                    self._index_published)
+        self.file_index.scan()
+        self.file_index.start()
+
+    def build_pack(self, path):
+        """
+        Pack the resource directory into an archive served with pack
+        :return: Number of files packed
+        """
+        self.mime_table.load()
+        return PackedTree.build(self.resource_dir, path, self._content_type,
+                                self._compressible, self.compress_level,
+                                self.compress_min_size)
+
+    def _index_published(self, previous, snapshot):
+        """
+        Drop the state kept for files and directories that left the index.
+        Responses in flight hold their own references and are unaffected.
+        """
+        removed = previous.files - snapshot.files
+        if removed:
+            self.file_access_count.discard(removed)
+            for worker_counts in self.worker_counts.values():
+                for path in removed:
+                    worker_counts.pop(path, None)
+        for reldir in list(self.listing_cache):
+            if reldir not in snapshot.dirs:
+                self.listing_cache.pop(reldir, None)
+        if previous.root is not None and previous.root != snapshot.root:
+            self.listing_cache.clear()
+            for cache in (self.cache, self.mapped_files):
+                if cache:
+                    cache.drop_outside(snapshot.root)
+
+    def _reject(self, client_socket, client_ip, code=503):
+        """
+        Refuse a connection when the worker pool is saturated (503) or the
+        client has too many connections open (429)
+        """
+        if code == 503:
+            self.logger.warning("Worker pool saturated, rejecting client %s"
+                                % str(client_ip))
+        else:
+            self.logger.info("Too many connections, rejecting client %s" %
+                             str(client_ip))
+        if self.tls_context:
+            # Answering needs a handshake, which would stall accepting
+            client_socket.close()
+            return
+        error_response_header = "Retry-After: 1\r\nContent-Length: 0\r\n" +\
+                                "Connection: close\r\n\r\n"
+        response = self.response_status.format(self.status_codes[code]) +\
+            error_response_header
+        try:
+            client_socket.send(response.encode('ascii'))
+        except socket.error:
+            pass
+        client_socket.close()
+
+    def _bind(self, address=None, reuse_port=False):
+        """
+        Create the server socket and bind it to the configured address
+        :param address: Address to bind instead of the configured one, used
+                        by prefork workers to share the supervisor's port
+        :param reuse_port: Set SO_REUSEPORT so several processes can bind
+                           the same port
+        """
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if address:
+            server_socket.bind(address)
+            return server_socket
+        server_socket.bind((self.host, self.port))
+        self.host = socket.gethostbyaddr(socket.gethostname())[0]
+        self.port = server_socket.getsockname()[1]
+        self.logger.debug("Server bind at address %s:%s." %
+                          (self.host, self.port))
+        print("Server is started on %s:%s" % (self.host, self.port))
+        return server_socket
+
+    def _start(self, server_socket):
+        """
+        Load the mime types, index the resource directory, start the access
+        log and listen on the server socket
+        """
+        self._timed('mime_types', self.mime_table.load)
+        self._timed('file_index', self._set_files)
+        self._timed('access_log', self.access_log.start)
+        if self.proxy:
+            self._timed('proxy', self.proxy.start)
+        self._timed('listen', server_socket.listen, self.backlog)
+        self._report_startup()
+        self.logger.info("Server listening at %s:%s" %
+                         (self.host, self.port))
+
+    def run_server(self, server_socket=None):
+        """
+        Start the server on random port and hand client requests to the
+        worker pool. Connections wait for their requests in a selector on
+        the accepting thread and are only submitted to the pool once a
+        complete request is buffered, so idle keep-alive connections and
+        clients slow to send their headers do not hold a worker.
+        :param server_socket: Already bound socket to serve from
+        """
+        self.pool = WorkerPool(self.listen, self.workers, self.queue_size)
+        selector = selectors.DefaultSelector()
+        self.parked = collections.deque()
+        self.park_reader, self.park_writer = socket.socketpair()
+        self.park_reader.setblocking(False)
+        selector.register(self.park_reader, selectors.EVENT_READ)
+        try:
+            server_socket = server_socket or self._timed('bind', self._bind)
+            self._timed('worker_pool', self.pool.start)
+            self._start(server_socket)
+            server_socket.setblocking(False)
+            selector.register(server_socket, selectors.EVENT_READ)
+            # Reads only happen on this thread
+            self.recv_buffer = bytearray(self.recv_size)
+            self.recv_view = memoryview(self.recv_buffer)
+            last_sweep = time.time()
             while True:
-                client_socket, client_ip = server_socket.accept()
-                self._set_files()
-                thread_args = (client_socket, client_ip)
-                client_thread = threading.Thread(target=self.listen,
-                                                 args=thread_args)
-                threads.append(client_thread)
-                client_thread.start()
+                for key, mask in selector.select(timeout=1):
+                    if key.fileobj is server_socket:
+                        try:
+                            self._on_accept(selector, server_socket)
+                        except Exception as e:
+                            self.logger.error("Accepting failed: %r" % e)
+                        continue
+                    if key.fileobj is self.park_reader:
+                        self._on_parked(selector)
+                        continue
+                    conn = key.data
+                    try:
+                        if conn.handshaking:
+                            self._on_handshake(selector, conn,
+                                               self._on_waiting)
+                        elif mask & selectors.EVENT_WRITE:
+                            # Only error replies are sent from this thread
+                            self._on_writable(selector, conn)
+                        else:
+                            self._on_waiting(selector, conn)
+                    except Exception as e:
+                        self._on_error(selector, conn, e)
+                if time.time() - last_sweep >= 1:
+                    last_sweep = time.time()
+                    self._close_idle(selector)
         except IOError as e:
             raise e
         except Exception as e:
@@ -161,16 +3019,697 @@ class HTTP_Server():
         except KeyboardInterrupt:
             pass
         finally:
-            for thread in threads:
-                thread.join()
-            server_socket.close()
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+            self.pool.shutdown()
+            self.park_writer.close()
+            self.logger.info("Worker pool stats: %s" % self.pool.stats())
+            if self.cache:
+                self.logger.info("Response cache stats: %s" %
+                                 self.cache.stats())
+            if server_socket:
+                server_socket.close()
+            if self.proxy:
+                self.proxy.stop()
+            if self.file_index:
+                self.file_index.stop()
+            self.access_log.stop()
+            self.logger.info("Server connection closed.")
+
+    def run_event_loop(self, server_socket=None):
+        """
+        Start the server on random port and multiplex all the client
+        connections on a single thread with a selector.
+        :param server_socket: Already bound socket to serve from
+        """
+        selector = selectors.DefaultSelector()
+        try:
+            server_socket = server_socket or self._timed('bind', self._bind)
+            self._start(server_socket)
+            server_socket.setblocking(False)
+            selector.register(server_socket, selectors.EVENT_READ)
+            if self.proxy:
+                self.proxy_pool = WorkerPool(self._proxy_work, self.workers,
+                                             self.queue_size)
+                self.proxy_pool.start()
+                self.wake_reader, self.wake_writer = socket.socketpair()
+                self.wake_reader.setblocking(False)
+                selector.register(self.wake_reader, selectors.EVENT_READ)
+            # One receive buffer is enough as reads never overlap
+            self.recv_buffer = bytearray(self.recv_size)
+            self.recv_view = memoryview(self.recv_buffer)
+            last_sweep = time.time()
+            while True:
+                for key, mask in selector.select(timeout=1):
+                    if key.fileobj is server_socket:
+                        try:
+                            self._on_accept(selector, server_socket)
+                        except Exception as e:
+                            self.logger.error("Accepting failed: %r" % e)
+                        continue
+                    if key.fileobj is self.wake_reader:
+                        self._on_proxy_done(selector)
+                        continue
+                    conn = key.data
+                    try:
+                        if conn.handshaking:
+                            self._on_handshake(selector, conn)
+                            continue
+                        if mask & selectors.EVENT_WRITE:
+                            self._on_writable(selector, conn)
+                        if mask & selectors.EVENT_READ and not conn.closed:
+                            self._on_readable(selector, conn)
+                    except Exception as e:
+                        self._on_error(selector, conn, e)
+                if time.time() - last_sweep >= 1:
+                    last_sweep = time.time()
+                    self._close_idle(selector)
+        except IOError as e:
+            raise e
+        except Exception as e:
+            self.logger.error(e)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+            if self.proxy_pool:
+                self.proxy_pool.shutdown()
+                self.wake_writer.close()
+            if self.proxy:
+                self.proxy.stop()
+            if self.file_index:
+                self.file_index.stop()
+            self.access_log.stop()
+            if self.cache:
+                self.logger.info("Response cache stats: %s" %
+                                 self.cache.stats())
             self.logger.info("Server connection closed.")
 
+    def run_prefork(self, processes, mode='threaded', reuse_port=True):
+        """
+        Start a supervisor that runs the server in several worker processes
+        sharing the port, restarts workers that exit and aggregates their
+        access counts. Each report is answered with the counts of the other
+        workers, so the access log and the metrics of every worker show
+        totals for the whole server, across worker restarts.
+        :param processes: Number of worker processes
+        :param mode: Serving engine of the workers, 'threaded' or 'eventloop'
+        :param reuse_port: Give each worker its own socket bound with
+                           SO_REUSEPORT so the kernel balances connections;
+                           otherwise the workers share the listening socket
+        """
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, stop)
+        reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        context = multiprocessing.get_context('fork')
+        server_socket = self._timed('bind', self._bind, None, reuse_port)
+        # Compiled once here and inherited by every worker
+        self._timed('mime_types', self.mime_table.load)
+        if not reuse_port:
+            server_socket.listen(self.backlog)
+        self.worker_counts = {}
+        workers = {}
+        worker_id = 0
+        try:
+            while True:
+                while len(workers) < processes:
+                    worker_id += 1
+                    channel, worker_channel = context.Pipe()
+                    process = context.Process(
+                        target=self._prefork_worker,
+                        args=(server_socket, mode, reuse_port,
+                              worker_channel),
+                        name="http-worker-%d" % worker_id)
+                    process.start()
+                    worker_channel.close()
+                    workers[channel] = (worker_id, process, time.time())
+                    self.logger.info("Started worker %d (pid %d)" %
+                                     (worker_id, process.pid))
+                ready = multiprocessing.connection.wait(
+                    list(workers.keys()), timeout=self.report_interval)
+                for channel in ready:
+                    self._read_worker_counts(channel, workers[channel][0])
+                    self._send_other_counts(channel, workers[channel][0])
+                for channel, (wid, process, started) in list(workers.items()):
+                    if process.is_alive():
+                        continue
+                    self._read_worker_counts(channel, wid)
+                    channel.close()
+                    process.join()
+                    del workers[channel]
+                    self.logger.error("Worker %d (pid %d) exited with code "
+                                      "%s, restarting" %
+                                      (wid, process.pid, process.exitcode))
+                    if time.time() - started < 1:
+                        # Avoid a busy loop of workers crashing on startup
+                        time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for channel, (wid, process, started) in workers.items():
+                if process.is_alive():
+                    process.terminate()
+            for channel, (wid, process, started) in workers.items():
+                process.join()
+                self._read_worker_counts(channel, wid)
+                channel.close()
+            server_socket.close()
+            self.logger.info("Access counts of all workers: %s" %
+                             self.access_counts())
+            self.logger.info("Supervisor stopped.")
+
+    def _prefork_worker(self, server_socket, mode, reuse_port, channel):
+        """
+        Body of a prefork worker process: serve requests with the chosen
+        engine and report the access counts to the supervisor periodically.
+        A worker whose supervisor has died stops instead of serving on.
+        :param channel: Pipe to the supervisor, which answers each report
+                        with the counts of the other workers
+        """
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+        # The supervisor decides when workers stop
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, stop)
+        self.worker_counts = {}
+        if reuse_port:
+            address = server_socket.getsockname()
+            server_socket.close()
+            server_socket = self._timed('bind', self._bind, address, True)
+        stop_event = threading.Event()
+        supervisor = os.getppid()
+
+        def report():
+            while not stop_event.wait(self.report_interval):
+                try:
+                    if os.getppid() != supervisor:
+                        raise BrokenPipeError("supervisor exited")
+                    channel.send(self.file_access_count.counts())
+                    if channel.poll(self.report_interval):
+                        self.worker_counts = {'others': channel.recv()}
+                except (OSError, EOFError) as e:
+                    self.logger.warning("Worker %d stopping: %s" %
+                                        (os.getpid(), e))
+                    os.kill(os.getpid(), signal.SIGTERM)
+                    return
+        reporter = threading.Thread(target=report, name="count-report")
+        reporter.daemon = True
+        reporter.start()
+        try:
+            if mode == 'eventloop':
+                self.run_event_loop(server_socket)
+            else:
+                self.run_server(server_socket)
+        finally:
+            stop_event.set()
+            reporter.join()
+            try:
+                channel.send(self.file_access_count.counts())
+            except OSError:
+                pass
+            channel.close()
+
+    def _read_worker_counts(self, channel, worker_id):
+        """
+        Keep the latest access counts a worker reported
+        """
+        try:
+            while channel.poll():
+                self.worker_counts[worker_id] = channel.recv()
+        except (EOFError, OSError):
+            pass
+
+    def _send_other_counts(self, channel, worker_id):
+        """
+        Answer a worker's report with the access counts of all the other
+        workers, including the ones that have exited
+        """
+        own = self.worker_counts.get(worker_id, {})
+        others = {}
+        for path, count in self.access_counts().items():
+            count -= own.get(path, 0)
+            if count:
+                others[path] = count
+        try:
+            channel.send(others)
+        except OSError:
+            # The worker is exiting
+            pass
+
+    def _on_accept(self, selector, server_socket):
+        """
+        Accept all the pending connections and watch them for requests
+        """
+        while True:
+            try:
+                client_socket, client_ip = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            self.logger.info("Connection request from client %s" %
+                             str(client_ip))
+            if self.limiter and not self.limiter.connect(client_ip[0]):
+                self._reject(client_socket, client_ip, 429)
+                continue
+            client_socket.setblocking(False)
+            self.metrics.inc('http_connections_opened_total')
+            if self.tls_context:
+                client_socket = self.tls_context.wrap_socket(
+                    client_socket, server_side=True,
+                    do_handshake_on_connect=False)
+            conn = Connection(client_socket, client_ip)
+            conn.parser = RequestParser(self.max_header_size,
+                                        max_body_size=self.max_body_size)
+            conn.handshaking = self.tls_context is not None
+            selector.register(client_socket, selectors.EVENT_READ, conn)
+
+    def _on_handshake(self, selector, conn, on_readable=None):
+        """
+        Advance the TLS handshake of a connection without blocking
+        :param on_readable: Handler of the connection once it is readable,
+                            _on_readable by default
+        """
+        try:
+            conn.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            selector.modify(conn.socket, selectors.EVENT_READ, conn)
+            return
+        except ssl.SSLWantWriteError:
+            selector.modify(conn.socket, selectors.EVENT_WRITE, conn)
+            return
+        except (ssl.SSLError, socket.error) as e:
+            self.logger.debug("TLS handshake with client %s failed: %s" %
+                              (str(conn.client_ip), e))
+            self.metrics.inc('http_tls_handshake_failures_total')
+            self._close_connection(selector, conn)
+            return
+        conn.handshaking = False
+        conn.last_active = time.time()
+        self._handshake_done(conn.socket)
+        selector.modify(conn.socket, selectors.EVENT_READ, conn)
+        if conn.socket.pending():
+            (on_readable or self._on_readable)(selector, conn)
+
+    def _on_proxy_done(self, selector):
+        """
+        Send the proxied replies completed by the proxy threads
+        """
+        try:
+            while self.wake_reader.recv(4096):
+                pass
+        except WOULD_BLOCK:
+            pass
+        while self.proxy_done:
+            conn = self.proxy_done.popleft()
+            if not conn.closed:
+                try:
+                    self._process_requests(selector, conn)
+                except Exception as e:
+                    self._on_error(selector, conn, e)
+
+    def _close_idle(self, selector):
+        """
+        Enforce the per-phase timeouts: answer 408 to clients that take
+        longer than header_timeout to send a request header, and close
+        connections idle for longer than the keep-alive timeout or stalled
+        for longer than send_timeout while receiving a reply.
+        """
+        now = time.time()
+        for key in list(selector.get_map().values()):
+            conn = key.data
+            if conn is None:
+                # Listening socket or wakeup pipe
+                continue
+            if conn.handshaking:
+                if conn.last_active < now - self.header_timeout:
+                    self.logger.debug("TLS handshake timed out for client %s"
+                                      % str(conn.client_ip))
+                    self._close_connection(selector, conn)
+            elif conn.replies:
+                if conn.last_active < now - self.send_timeout:
+                    self.logger.debug("Send timed out for client %s" %
+                                      str(conn.client_ip))
+                    self._close_connection(selector, conn)
+            elif conn.parser.pending():
+                if conn.parser.started < now - self.header_timeout and \
+                        not conn.closing:
+                    self.logger.debug("Request timed out for client %s" %
+                                      str(conn.client_ip))
+                    conn.replies.append(self._error_response(408))
+                    conn.closing = True
+                    selector.modify(conn.socket, selectors.EVENT_WRITE, conn)
+            elif conn.last_active < now - self.keepalive_timeout:
+                self.logger.debug("Idle connection timed out for client %s" %
+                                  str(conn.client_ip))
+                self._close_connection(selector, conn)
+
+    def _on_readable(self, selector, conn):
+        """
+        Feed received bytes to the parser and queue the replies of complete
+        requests
+        """
+        if self._receive(selector, conn):
+            self._process_requests(selector, conn)
+
+    def _on_waiting(self, selector, conn):
+        """
+        Feed received bytes to the parser of a connection waiting in the
+        threaded engine's selector, and submit the connection to the worker
+        pool once a complete request is buffered
+        """
+        if not self._receive(selector, conn):
+            return
+        started = time.perf_counter()
+        try:
+            request = conn.parser.next_request()
+        except RequestError as e:
+            self.logger.warning("Invalid request from client: %s" % e)
+            conn.replies.append(self._error_response(e.code))
+            conn.closing = True
+            selector.modify(conn.socket, selectors.EVENT_WRITE, conn)
+            return
+        if request is None:
+            return
+        self.metrics.observe('http_parse_seconds',
+                             time.perf_counter() - started)
+        selector.unregister(conn.socket)
+        if not self.pool.submit((conn, request), self.queue_timeout):
+            self._reject(conn.socket, conn.client_ip)
+            self._close_connection(None, conn)
+        self.logger.debug("Worker pool: %s" % self.pool.stats())
+
+    def _on_parked(self, selector):
+        """
+        Wait for the next request of the connections the workers are done
+        with
+        """
+        try:
+            while self.park_reader.recv(4096):
+                pass
+        except WOULD_BLOCK:
+            pass
+        while self.parked:
+            conn = self.parked.popleft()
+            try:
+                conn.socket.setblocking(False)
+                conn.last_active = time.time()
+                selector.register(conn.socket, selectors.EVENT_READ, conn)
+                if isinstance(conn.socket, ssl.SSLSocket) and \
+                        conn.socket.pending():
+                    self._on_waiting(selector, conn)
+            except Exception as e:
+                self._on_error(selector, conn, e)
+
+    def _receive(self, selector, conn):
+        """
+        Feed the bytes a connection received to its parser. TLS connections
+        are read until no decrypted bytes are left buffered, as the selector
+        only reports data still in the kernel.
+        :return: False if the connection was closed
+        """
+        while True:
+            try:
+                received = conn.socket.recv_into(self.recv_buffer)
+            except WOULD_BLOCK:
+                return True
+            except socket.error:
+                received = 0
+            if not received:
+                self._close_connection(selector, conn)
+                return False
+            conn.last_active = time.time()
+            conn.parser.feed(self.recv_view[:received])
+            if not isinstance(conn.socket, ssl.SSLSocket) or \
+                    not conn.socket.pending():
+                return True
+
+    def _process_requests(self, selector, conn):
+        """
+        Answer the buffered requests in order, up to the pipeline limit, and
+        update the events watched for the connection
+        """
+        while not conn.closing and len(conn.replies) < self.max_pipeline:
+            started = time.perf_counter()
+            try:
+                request = conn.parser.next_request()
+            except RequestError as e:
+                self.logger.warning("Invalid request from client: %s" % e)
+                conn.replies.append(self._error_response(e.code))
+                conn.closing = True
+                break
+            if request is None:
+                break
+            self.metrics.observe('http_parse_seconds',
+                                 time.perf_counter() - started)
+            if self.proxy and self.proxy.match(request) is not None:
+                # Upstreams are waited for on the proxy threads
+                keep_alive = self._reusable(request, conn.served)
+                response = PendingReply()
+                if not self.proxy_pool.submit((request, conn, response,
+                                               conn.served)):
+                    response = self._error_response(503)
+                    keep_alive = False
+            else:
+                response, keep_alive = self._handle_request(
+                    request, conn.served, conn.client_ip)
+            conn.served += 1
+            conn.replies.append(response)
+            conn.closing = not keep_alive
+
+        if conn.closing and not conn.replies:
+            self._close_connection(selector, conn)
+            return
+        ready = conn.replies and not (isinstance(conn.replies[0], PendingReply)
+                                      and conn.replies[0].response is None)
+        events = selectors.EVENT_WRITE if ready else 0
+        if not conn.closing and len(conn.replies) < self.max_pipeline:
+            events |= selectors.EVENT_READ
+        selector.modify(conn.socket, events, conn)
+
+    def _on_writable(self, selector, conn):
+        """
+        Send as much of the pending replies as the socket accepts
+        """
+        while conn.replies:
+            response = conn.replies[0]
+            if isinstance(response, PendingReply):
+                if response.response is None:
+                    break
+                response = conn.replies[0] = response.response
+            conn.last_active = time.time()
+            if response.send_started is None:
+                response.send_started = time.perf_counter()
+            try:
+                response.send(conn.socket)
+            except WOULD_BLOCK:
+                return
+            except (socket.error, IOError) as e:
+                self.logger.warning(e)
+                self._close_connection(selector, conn)
+                return
+            conn.replies.popleft()
+            self._complete(response, conn.client_ip,
+                           time.perf_counter() - response.send_started)
+        self._process_requests(selector, conn)
+
+    def _on_error(self, selector, conn, error):
+        """
+        Contain an unexpected error to the connection it happened on: the
+        client is answered 500 after its queued replies, or the connection
+        is closed if a reply was already partly sent
+        """
+        self.logger.error("Error serving client %s: %r" %
+                          (str(conn.client_ip), error))
+        if conn.closed:
+            return
+        try:
+            if conn.handshaking or (conn.replies and getattr(
+                    conn.replies[0], 'send_started', None) is not None):
+                self._close_connection(selector, conn)
+                return
+            conn.replies.append(self._error_response(500))
+            conn.closing = True
+            selector.modify(conn.socket, selectors.EVENT_WRITE, conn)
+        except Exception as e:
+            self.logger.error("Closing client %s failed: %r" %
+                              (str(conn.client_ip), e))
+            conn.closed = True
+            try:
+                selector.unregister(conn.socket)
+            except (KeyError, ValueError):
+                pass
+            conn.socket.close()
+
+    def _close_connection(self, selector, conn):
+        if selector is not None:
+            selector.unregister(conn.socket)
+        conn.socket.close()
+        conn.closed = True
+        self.metrics.inc('http_connections_closed_total')
+        if self.limiter:
+            self.limiter.disconnect(conn.client_ip[0])
+        for response in conn.replies:
+            response.close()
+        conn.replies.clear()
+
+
+def proxy_route(spec):
+    """
+    Parse a PREFIX=HOST:PORT[,HOST:PORT...] proxy route argument
+    :return: Tuple of the path prefix and the list of (host, port) tuples
+    """
+    prefix, _, upstreams = spec.partition('=')
+    try:
+        addresses = []
+        for upstream in upstreams.split(','):
+            host, _, port = upstream.strip().rpartition(':')
+            addresses.append((host or '127.0.0.1', int(port)))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid proxy route %r" % spec)
+    if not prefix.startswith('/'):
+        raise argparse.ArgumentTypeError("Invalid proxy route %r" % spec)
+    return prefix, addresses
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-p', '--port', type=int, default=0,
+                        help="Port to listen on (default: random)")
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help="Number of worker threads")
+    parser.add_argument('-q', '--queue-size', type=int, default=32,
+                        help="Connections with a complete request allowed "
+                             "to wait for a worker (0 for unbounded)")
+    parser.add_argument('-t', '--queue-timeout', type=float, default=0,
+                        help="Seconds to wait for a queue slot before "
+                             "rejecting a connection with 503")
+    parser.add_argument('-m', '--mode', choices=['threaded', 'eventloop'],
+                        default='threaded',
+                        help="Serving engine: worker pool threads or a "
+                             "single-threaded selector event loop")
+    parser.add_argument('-k', '--keepalive-timeout', type=float, default=5,
+                        help="Seconds an idle persistent connection is kept "
+                             "open")
+    parser.add_argument('-r', '--max-requests', type=int, default=100,
+                        help="Requests served on one connection before it "
+                             "is closed")
+    parser.add_argument('-c', '--cache-size', type=float, default=32,
+                        help="Megabytes of file responses kept in memory "
+                             "(0 disables the cache)")
+    parser.add_argument('-i', '--rescan-interval', type=float, default=2,
+                        help="Seconds between checks of the resource "
+                             "directory for added or removed files")
+    parser.add_argument('--no-compression', dest='compression',
+                        action='store_false',
+                        help="Never gzip or deflate encode responses")
+    parser.add_argument('-n', '--processes', type=int, default=0,
+                        help="Run this many worker processes under a "
+                             "supervisor (0 serves from this process)")
+    parser.add_argument('--no-reuseport', dest='reuse_port',
+                        action='store_false',
+                        help="Prefork workers share one inherited listening "
+                             "socket instead of SO_REUSEPORT sockets")
+    parser.add_argument('--mmap-size', type=float, default=256,
+                        help="Megabytes of files too large for the response "
+                             "cache kept memory mapped (0 to disable, "
+                             "not used with --certfile)")
+    parser.add_argument('-l', '--access-log', default='-',
+                        help="File the access log is appended to (- for "
+                             "stdout)")
+    parser.add_argument('--access-log-format', default='pipe',
+                        choices=AccessLogWriter.formats,
+                        help="Access log line format")
+    parser.add_argument('--access-log-buffer', type=int, default=65536,
+                        help="Access log entries buffered before new ones "
+                             "are dropped")
+    parser.add_argument('--mime-cache',
+                        help="File the compiled mime type table is cached in")
+    parser.add_argument('--startup-report', action='store_true',
+                        help="Print how long each startup step took")
+    parser.add_argument('--certfile',
+                        help="PEM certificate chain; serves HTTPS when given")
+    parser.add_argument('--keyfile',
+                        help="PEM private key, if not in the certificate file")
+    parser.add_argument('--tls-tickets', type=int, default=2,
+                        help="TLS 1.3 session tickets issued per full "
+                             "handshake (0 to disable resumption by ticket)")
+    parser.add_argument('--listings', action='store_true',
+                        help="Serve generated listings of directories "
+                             "without an index.html")
+    parser.add_argument('--proxy', type=proxy_route, action='append',
+                        metavar='PREFIX=HOST:PORT[,HOST:PORT...]',
+                        help="Forward requests under the path prefix to the "
+                             "upstreams (repeatable)")
+    parser.add_argument('--upstream-connections', type=int, default=8,
+                        help="Concurrent connections kept to each upstream")
+    parser.add_argument('--upstream-timeout', type=float, default=10,
+                        help="Seconds to wait for an upstream")
+    parser.add_argument('--health-interval', type=float, default=5,
+                        help="Seconds between upstream health checks")
+    parser.add_argument('-b', '--backlog', type=int, default=128,
+                        help="Listen backlog of the server socket")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Requests per second allowed per client address "
+                             "(0 for no limit)")
+    parser.add_argument('--burst', type=int, default=0,
+                        help="Requests a client may make at once above the "
+                             "rate (default: one second worth)")
+    parser.add_argument('--max-client-connections', type=int, default=0,
+                        help="Connections allowed per client address "
+                             "(0 for no limit)")
+    parser.add_argument('--metrics-path', default='/metrics',
+                        help="Path serving metrics in the Prometheus text "
+                             "format (empty to disable)")
+    parser.add_argument('--pack',
+                        help="Serve the files from this archive of the "
+                             "resource directory instead of the directory")
+    parser.add_argument('--build-pack', metavar='PACK',
+                        help="Pack the resource directory into an archive "
+                             "for --pack and exit")
+    return parser.parse_args()
+
 
 if __name__ == '__main__':
+    args = parse_args()
     try:
-        soc = HTTP_Server()
-        soc.run_server()
+        soc = HTTP_Server(port=args.port, workers=args.workers,
+                          queue_size=args.queue_size,
+                          queue_timeout=args.queue_timeout,
+                          keepalive_timeout=args.keepalive_timeout,
+                          max_keepalive_requests=args.max_requests,
+                          cache_size=int(args.cache_size * (1 << 20)),
+                          rescan_interval=args.rescan_interval,
+                          compression=args.compression,
+                          metrics_path=args.metrics_path,
+                          mmap_size=int(args.mmap_size * (1 << 20)),
+                          access_log=args.access_log,
+                          access_log_format=args.access_log_format,
+                          access_log_buffer=args.access_log_buffer,
+                          mime_cache=args.mime_cache,
+                          startup_report=args.startup_report,
+                          certfile=args.certfile, keyfile=args.keyfile,
+                          tls_tickets=args.tls_tickets,
+                          listings=args.listings,
+                          proxy_routes=args.proxy,
+                          upstream_connections=args.upstream_connections,
+                          upstream_timeout=args.upstream_timeout,
+                          health_interval=args.health_interval,
+                          backlog=args.backlog, rate=args.rate,
+                          burst=args.burst,
+                          max_client_connections=args.max_client_connections,
+                          pack=args.pack)
+        if args.build_pack:
+            print("Packed %d files into %s" %
+                  (soc.build_pack(args.build_pack), args.build_pack))
+        elif args.processes > 0:
+            soc.run_prefork(args.processes, args.mode, args.reuse_port)
+        elif args.mode == 'eventloop':
+            soc.run_event_loop()
+        else:
+            soc.run_server()
         sys.exit(0)
     except IOError as e:
         print(e)
@@ -0,0 +1,10 @@
+#! /bin/sh
+#
+# make_cert.sh
+#
+# Create a self-signed certificate for testing the server over HTTPS:
+#     sh make_cert.sh && sh server.sh --certfile cert.pem --keyfile key.pem
+
+openssl req -x509 -newkey rsa:2048 -nodes -days 365 -subj "/CN=localhost" \
+    -addext "subjectAltName=DNS:localhost,IP:127.0.0.1" \
+    -keyout "${1:-key.pem}" -out "${2:-cert.pem}"
@@ -5,5 +5,5 @@
 #
 # Wrapper shell script for python script
 
-python http_server.py
+python3 http_server.py "$@"
 
@@ -0,0 +1,413 @@
+#! /usr/bin/env python3
+
+"""
+Unit tests for the request parsing and response negotiation helpers
+"""
+
+import http.server
+import io
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from http_server import (AccessLogWriter, CachedFile, ContentStat,
+                         HTTP_Server, RequestError, RequestParser, Response,
+                         ReverseProxy, UpstreamBody, UpstreamError)
+
+
+class ParseRangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTP_Server()
+
+    def test_single_ranges(self):
+        self.assertEqual(self.server._parse_ranges('bytes=0-4', 10), [(0, 4)])
+        self.assertEqual(self.server._parse_ranges('bytes=5-', 10), [(5, 9)])
+        self.assertEqual(self.server._parse_ranges('bytes=-3', 10), [(7, 9)])
+        self.assertEqual(self.server._parse_ranges('bytes=8-20', 10),
+                         [(8, 9)])
+
+    def test_multiple_ranges(self):
+        self.assertEqual(self.server._parse_ranges('bytes=0-0, -2', 10),
+                         [(0, 0), (8, 9)])
+
+    def test_unsatisfiable(self):
+        self.assertEqual(self.server._parse_ranges('bytes=20-', 10), [])
+        self.assertEqual(self.server._parse_ranges('bytes=-0', 10), [])
+        self.assertEqual(self.server._parse_ranges('bytes=-5', 0), [])
+        self.assertEqual(self.server._parse_ranges('bytes=0-', 0), [])
+
+    def test_ignored(self):
+        for value in ('items=0-4', 'bytes=--5', 'bytes=-', 'bytes=a-',
+                      'bytes=4-2', 'bytes=0-4-', 'bytes=1', 'bytes=-+5'):
+            self.assertIsNone(self.server._parse_ranges(value, 10), value)
+
+    def test_too_many_ranges(self):
+        value = 'bytes=' + ','.join(['0-0'] * (self.server.max_ranges + 1))
+        self.assertIsNone(self.server._parse_ranges(value, 10))
+
+
+class NegotiateEncodingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTP_Server()
+
+    def test_preference(self):
+        negotiate = self.server._negotiate_encoding
+        self.assertEqual(negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(negotiate('deflate'), 'deflate')
+        self.assertEqual(negotiate('gzip;q=0.5, deflate'), 'deflate')
+        self.assertEqual(negotiate('deflate;q=0.5, gzip;q=0.5'), 'gzip')
+        self.assertIsNone(negotiate(''))
+        self.assertIsNone(negotiate('br, identity'))
+
+    def test_refused(self):
+        negotiate = self.server._negotiate_encoding
+        self.assertIsNone(negotiate('gzip;q=0'))
+        self.assertIsNone(negotiate('gzip;q=0, deflate;q=0'))
+        self.assertEqual(negotiate('gzip;q=0, deflate'), 'deflate')
+        self.assertEqual(negotiate('gzip;q=x, deflate'), 'deflate')
+
+
+class RequestParserTest(unittest.TestCase):
+
+    def test_pipelined_requests(self):
+        parser = RequestParser()
+        parser.feed(b'GET /a.html HTTP/1.1\r\nHost: x\r\n\r\n'
+                    b'HEAD /b%20c HTTP/1.0\r\n\r\n')
+        first = parser.next_request()
+        self.assertEqual((first.method, first.requested_file, first.version),
+                         ('GET', 'a.html', '1.1'))
+        self.assertEqual(first.headers['host'], 'x')
+        second = parser.next_request()
+        self.assertEqual((second.method, second.requested_file),
+                         ('HEAD', 'b c'))
+        self.assertIsNone(parser.next_request())
+        self.assertFalse(parser.pending())
+
+    def test_partial_request(self):
+        parser = RequestParser()
+        parser.feed(b'GET / HTTP/1.1\r\nHo')
+        self.assertIsNone(parser.next_request())
+        self.assertTrue(parser.pending())
+        parser.feed(b'st: x\r\n\r\n')
+        self.assertEqual(parser.next_request().requested_file, '')
+
+    def test_body(self):
+        parser = RequestParser()
+        parser.feed(b'POST /f HTTP/1.1\r\nContent-Length: 3\r\n\r\nab')
+        self.assertIsNone(parser.next_request())
+        parser.feed(b'c')
+        self.assertEqual(parser.next_request().body, b'abc')
+
+    def assertRejected(self, data, code, **limits):
+        parser = RequestParser(**limits)
+        parser.feed(data)
+        with self.assertRaises(RequestError) as context:
+            parser.next_request()
+        self.assertEqual(context.exception.code, code)
+
+    def test_invalid_requests(self):
+        self.assertRejected(b'GET\r\n\r\n', 400)
+        self.assertRejected(b'GET / HTTP/2.0\r\n\r\n', 505)
+        self.assertRejected(b'GET / HTTP/1.1\r\nbad header\r\n\r\n', 400)
+        self.assertRejected(b'POST / HTTP/1.1\r\nContent-Length: x\r\n\r\n',
+                            400)
+        self.assertRejected(b'POST / HTTP/1.1\r\nContent-Length: 9\r\n\r\n',
+                            413, max_body_size=8)
+        self.assertRejected(b'GET / HTTP/1.1\r\nA: ' + b'a' * 100, 431,
+                            max_header_size=64)
+        self.assertRejected(b'GET / HTTP/1.1\r\nA: 1\r\nB: 2\r\n\r\n', 431,
+                            max_headers=1)
+
+
+class NotModifiedTest(unittest.TestCase):
+
+    def setUp(self):
+        # Sun, 06 Nov 1994 08:49:37 GMT
+        self.entry = CachedFile('www/f', ContentStat(784111777.0, 5),
+                                'Sun, 06 Nov 1994 08:49:37 GMT', 'text/plain',
+                                b'hello')
+
+    def test_etag(self):
+        self.assertTrue(self.entry.not_modified(
+            {'if-none-match': self.entry.etag}))
+        self.assertTrue(self.entry.not_modified(
+            {'if-none-match': '"x", W/' + self.entry.etag}))
+        self.assertTrue(self.entry.not_modified({'if-none-match': '*'}))
+        self.assertFalse(self.entry.not_modified({'if-none-match': '"x"'}))
+
+    def test_etag_takes_precedence(self):
+        self.assertFalse(self.entry.not_modified(
+            {'if-none-match': '"x"',
+             'if-modified-since': 'Sun, 06 Nov 1994 08:49:37 GMT'}))
+
+    def test_modified_since(self):
+        self.assertTrue(self.entry.not_modified(
+            {'if-modified-since': 'Sun, 06 Nov 1994 08:49:37 GMT'}))
+        self.assertFalse(self.entry.not_modified(
+            {'if-modified-since': 'Sat, 05 Nov 1994 08:49:37 GMT'}))
+
+    def test_invalid_dates_ignored(self):
+        for value in ('yesterday', 'Sun, 06 Nov 99999 08:49:37 GMT'):
+            self.assertFalse(self.entry.not_modified(
+                {'if-modified-since': value}), value)
+
+
+class AccessCountTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTP_Server()
+        self.stream = io.StringIO()
+        self.server.access_log = AccessLogWriter(self.stream, capacity=2)
+
+    def serve(self, requested_file, code=200):
+        response = Response(code, b'HTTP/1.1 200 OK\r\n\r\n')
+        response.requested_file = requested_file
+        self.server._record_access(response, ('127.0.0.1', 8000))
+
+    def logged(self):
+        self.server.access_log.flush()
+        lines = self.stream.getvalue().splitlines()
+        self.stream.seek(0)
+        self.stream.truncate()
+        return lines
+
+    def test_log_follows_counter(self):
+        for _ in range(3):
+            self.serve('a.html')
+        self.serve('b.html', 404)
+        # The third entry overflowed the buffer but was still counted
+        self.assertEqual(self.logged(), ['/a.html|127.0.0.1|8000|1',
+                                         '/a.html|127.0.0.1|8000|2'])
+        self.serve('a.html')
+        self.assertEqual(self.logged(), ['/a.html|127.0.0.1|8000|4'])
+        self.assertEqual(self.server.access_counts(), {'a.html': 4})
+        self.server.file_access_count.discard(['a.html'])
+        self.serve('a.html')
+        self.assertEqual(self.logged(), ['/a.html|127.0.0.1|8000|1'])
+
+    def test_generated_pages_not_counted(self):
+        self.server = HTTP_Server(listings=True)
+        self.server.access_log = AccessLogWriter(self.stream)
+        self.server.resource_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.server.resource_dir)
+        os.mkdir(os.path.join(self.server.resource_dir, 'sub'))
+        self.server._set_files()
+        self.addCleanup(self.server.file_index.stop)
+        for response in (self.server._make_response(requested_file='sub/'),
+                         self.server._metrics_response(False, 0)):
+            self.assertEqual(response.code, 200)
+            self.server._record_access(response, ('127.0.0.1', 8000))
+        self.assertEqual(self.logged(), [])
+        self.assertEqual(self.server.access_counts(), {})
+
+
+class MappedFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def load(self, server, size):
+        path = os.path.join(self.directory, 'f.bin')
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        fin = open(path, 'rb')
+        self.addCleanup(fin.close)
+        return server._load_file(fin, path, 'f.bin')
+
+    def test_small_files_not_mapped(self):
+        # Sent along with the header, the body is copied in userspace
+        server = HTTP_Server(cache_size=0)
+        entry = self.load(server, 1000)
+        self.assertIsInstance(entry.body, bytes)
+        self.assertFalse(server.mapped_files.entries)
+        entry = self.load(server, Response.chunk_size)
+        self.assertIsInstance(entry.body, memoryview)
+
+    @unittest.skipUnless(shutil.which('openssl'), "openssl not available")
+    def test_not_mapped_with_tls(self):
+        certfile = os.path.join(self.directory, 'cert.pem')
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-subj', '/CN=localhost', '-days', '1', '-keyout', certfile,
+             '-out', certfile], stderr=subprocess.DEVNULL)
+        server = HTTP_Server(cache_size=0, certfile=certfile)
+        self.assertIsNone(server.mapped_files)
+        entry = self.load(server, Response.chunk_size)
+        self.assertIsNone(entry.body)
+
+
+class ThreadedEngineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTP_Server(workers=1, access_log=os.devnull)
+        cls.server.resource_dir = os.path.join(os.path.dirname(__file__),
+                                               'www')
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.bind(('127.0.0.1', 0))
+        # Accepted connections wait in the backlog until the server starts
+        server_socket.listen()
+        cls.address = server_socket.getsockname()
+        thread = threading.Thread(target=cls.server.run_server,
+                                  args=(server_socket,))
+        thread.daemon = True
+        thread.start()
+
+    def connect(self):
+        client = socket.create_connection(self.address, timeout=2)
+        self.addCleanup(client.close)
+        return client
+
+    def get(self, client):
+        client.sendall(b'HEAD /pdf-sample.pdf HTTP/1.1\r\nHost: x\r\n\r\n')
+        reply = b''
+        while b'\r\n\r\n' not in reply:
+            reply += client.recv(4096)
+        return reply.split(b'\r\n')[0]
+
+    def test_waiting_clients_do_not_hold_workers(self):
+        # The only worker must stay free for clients with a request ready
+        idle = [self.connect() for _ in range(3)]
+        for client in idle:
+            self.assertEqual(self.get(client), b'HTTP/1.1 200 OK')
+        for _ in range(3):
+            self.connect().sendall(b'GET / HTTP/1.1\r\nHo')
+        self.assertEqual(self.get(self.connect()), b'HTTP/1.1 200 OK')
+        self.assertEqual(self.get(idle[0]), b'HTTP/1.1 200 OK')
+
+    def test_pipelined_requests(self):
+        client = self.connect()
+        client.sendall(b'HEAD / HTTP/1.1\r\nHost: x\r\n\r\n' * 2 +
+                       b'BAD\r\n\r\n')
+        replies = b''
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            replies += data
+        self.assertEqual(replies.count(b'HTTP/1.1 '), 3)
+        self.assertIn(b'HTTP/1.1 400 ', replies)
+
+
+class Backend(http.server.BaseHTTPRequestHandler):
+    """
+    Stand-in upstream: /slow answers late, /big sends a large body, other
+    paths answer with the backend's port
+    """
+    protocol_version = 'HTTP/1.1'
+    big = b'0123456789abcdef' * 65536
+
+    def do_GET(self):
+        if self.path == '/api/slow':
+            time.sleep(0.5)
+        body = self.big if self.path == '/api/big' else \
+            str(self.server.server_address[1]).encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ReverseProxyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backends = []
+        for _ in range(2):
+            backend = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      Backend)
+            backend.daemon_threads = True
+            thread = threading.Thread(target=backend.serve_forever,
+                                      args=(0.05,))
+            thread.daemon = True
+            thread.start()
+            self.addCleanup(backend.server_close)
+            self.addCleanup(backend.shutdown)
+            self.backends.append(backend.server_address)
+        # Nothing listens on the port of a closed socket
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        self.closed = closed.getsockname()
+        closed.close()
+
+    def proxy(self, *addresses):
+        proxy = ReverseProxy([('/api', list(addresses))], timeout=0.2)
+        self.addCleanup(proxy.stop)
+        return proxy
+
+    def forward(self, proxy, path='/api/x', stream=False):
+        parser = RequestParser()
+        parser.feed(b'GET ' + path.encode('ascii') + b' HTTP/1.1\r\n'
+                    b'Host: x\r\n\r\n')
+        request = parser.next_request()
+        return proxy.forward(request, proxy.match(request),
+                             ('127.0.0.1', 5000), stream)
+
+    def test_connections_reused(self):
+        proxy = self.proxy(self.backends[0])
+        for _ in range(3):
+            self.assertEqual(self.forward(proxy)[0], 200)
+        stats = proxy.upstreams[0].stats()
+        self.assertEqual((stats['connects'], stats['reuses'], stats['idle']),
+                         (1, 2, 1))
+
+    def test_least_connections(self):
+        proxy = self.proxy(*self.backends)
+        first, second = proxy.upstreams
+        first.active = 1
+        port = str(second.address[1]).encode('ascii')
+        for _ in range(3):
+            self.assertEqual(self.forward(proxy)[3], port)
+
+    def test_failover(self):
+        proxy = self.proxy(self.closed, self.backends[0])
+        down, up = proxy.upstreams
+        for _ in range(3 * down.max_failures):
+            self.assertEqual(self.forward(proxy)[0], 200)
+        self.assertFalse(down.healthy)
+        self.assertEqual(up.stats()['requests'], 3 * down.max_failures)
+
+    def test_failure_threshold(self):
+        proxy = self.proxy(self.closed)
+        upstream = proxy.upstreams[0]
+        for _ in range(upstream.max_failures - 1):
+            self.assertRaises(UpstreamError, self.forward, proxy)
+            self.assertTrue(upstream.healthy)
+        self.assertRaises(UpstreamError, self.forward, proxy)
+        self.assertFalse(upstream.healthy)
+        with self.assertRaises(UpstreamError) as context:
+            self.forward(proxy)
+        self.assertEqual(context.exception.code, 503)
+
+    def test_timeouts_keep_upstream(self):
+        proxy = self.proxy(self.backends[0])
+        upstream = proxy.upstreams[0]
+        for _ in range(upstream.max_failures):
+            self.assertRaises(UpstreamError, self.forward, proxy,
+                              '/api/slow')
+        self.assertTrue(upstream.healthy)
+        self.assertEqual(self.forward(proxy)[0], 200)
+
+    def test_streamed_body(self):
+        proxy = self.proxy(self.backends[0])
+        status, reason, headers, body = self.forward(proxy, '/api/big',
+                                                     stream=True)
+        self.assertIsInstance(body, UpstreamBody)
+        self.assertEqual(b''.join(body), Backend.big)
+        self.assertEqual(proxy.upstreams[0].stats()['idle'], 1)
+        self.assertEqual(self.forward(proxy)[0], 200)
+        self.assertEqual(proxy.upstreams[0].stats()['reuses'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()